@@ -123,6 +123,10 @@ export class SekimiyaAiStack extends cdk.Stack {
       }),
       environment: {
         CHARACTER_SETTING: readFileSync('./lib/character_setting.txt', 'utf8'),
+        // cpu: 256 (0.25 vCPU) に合わせて、HTML の抽出や要約を動かすプロセスは 1 つ
+        CPU_WORKERS: '1',
+        // memoryLimitMiB: 512 に収まるよう、ゲートウェイのイベントと discord.py のキャッシュを絞る
+        MEMORY_BUDGET_MODE: 'true',
       },
     })
 
@@ -139,7 +143,7 @@ export class SekimiyaAiStack extends cdk.Stack {
       new iam.Policy(this, 'LogReadPolicy', {
         statements: [
           new iam.PolicyStatement({
-            actions: ['logs:DescribeLogStreams', 'logs:GetLogEvents'],
+            actions: ['logs:FilterLogEvents'],
             resources: [logGroup.attrArn],
             effect: iam.Effect.ALLOW,
           }),
@@ -181,9 +185,12 @@ export class SekimiyaAiStack extends cdk.Stack {
         index: 'main.py',
         handler: 'handler',
         memorySize: 2048,
+        // レートリミットやエラーで送り直す分の余裕を持たせる
+        timeout: cdk.Duration.minutes(1),
         environment: {
           CHANNEL_ID: channelId,
           IMPORTANCE_LEVEL: '3', // 星3の重要指標だけお知らせ
+          // 複数のチャンネルに送るときは SUBSCRIPTIONS に JSON で配信先を並べる
         },
       }
     )
@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "chatbot"))
+
+from bs4 import BeautifulSoup  # noqa: E402
+from corpus import load_pages  # noqa: E402
+from functions import browser, extractor, http_client  # noqa: E402
+
+
+def extract_with_bs4(body: bytes) -> str:
+    # 以前の fetch_website_summary と同じ処理
+    soup = BeautifulSoup(body.decode("utf-8", errors="replace"), "html.parser")
+    paragraphs = list(filter(None, [p.get_text() for p in soup.find_all("p")]))
+    return "\n".join(paragraphs)
+
+
+def extract_with_lxml(body: bytes) -> str:
+    chunks = [
+        body[i : i + http_client.CHUNK_SIZE]
+        for i in range(0, len(body), http_client.CHUNK_SIZE)
+    ]
+    return extractor.extract_paragraphs(
+        chunks, "utf-8", browser.EXTRACT_TOKEN_LIMIT, browser.count_tokens
+    )
+
+
+def measure(func, body: bytes) -> tuple[float, float, int]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    text = func(body)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024, len(text)
+
+
+def main():
+    print(f"{'page':<24} {'bytes':>9} {'parser':<6} {'time':>9} {'peak':>9} chars")
+    for name, html in load_pages():
+        body = html.encode("utf-8")
+        for parser_name, func in [
+            ("bs4", extract_with_bs4),
+            ("lxml", extract_with_lxml),
+        ]:
+            elapsed, peak, chars = measure(func, body)
+            print(
+                f"{name[:24]:<24} {len(body):>9} {parser_name:<6}"
+                f" {elapsed * 1000:>7.1f}ms {peak:>7.1f}MB {chars}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "chatbot"))
+
+# browser は sumy を使うときに読み込むので、その時間を計測に含めないよう先に読んでおく
+import sumy.summarizers.lex_rank  # noqa: E402,F401
+from corpus import load_pages  # noqa: E402
+from functions import browser  # noqa: E402
+
+SUMMARIZERS = ["lexrank", "numpy"]
+
+
+def measure(text: str, summarizer_name: str) -> tuple[float, float, int]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    summary = browser.summarize_text(text, summarizer_name=summarizer_name)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024, browser.count_tokens(summary)
+
+
+def main():
+    print(f"{'page':<24} {'tokens':>7} {'summarizer':<8} {'time':>9} {'peak':>9} out")
+    for name, html in load_pages():
+        text = browser.extract_text(html)
+        num_tokens = browser.count_tokens(text)
+        for summarizer_name in SUMMARIZERS:
+            elapsed, peak, out_tokens = measure(text, summarizer_name)
+            print(
+                f"{name[:24]:<24} {num_tokens:>7} {summarizer_name:<8}"
+                f" {elapsed * 1000:>7.1f}ms {peak:>7.1f}MB {out_tokens}"
+            )
+
+
+if __name__ == "__main__":
+    main()
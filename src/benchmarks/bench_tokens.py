@@ -0,0 +1,64 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "chatbot"))
+
+import tokens  # noqa: E402
+from encoder import get_encoding  # noqa: E402
+
+SMALL_MODEL_TOKEN_LIMIT = 1024 * 4 * 0.9
+CHAIN_LENGTHS = [10, 50, 200, 500]
+SAMPLE_WORDS = ["関宮", "ラーメン", "新宿駅", "おすすめ", "教えて", "ですｗ", "FX", "今日"]
+
+
+def make_chain(length: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    messages = [{"role": "system", "content": "あなたは関宮です。" * 20}]
+    for i in range(length):
+        content = "".join(rng.choices(SAMPLE_WORDS, k=rng.randint(10, 80)))
+        messages.append({"role": "user" if i % 2 else "assistant", "content": content})
+    return messages
+
+
+def naive_trim(messages: list, token_limit: float) -> int:
+    # 以前の get_completion と同じく、1件削るたびに全件エンコードし直す
+    def count(messages):
+        encoding = get_encoding()
+        num_tokens = 0
+        for message in messages:
+            num_tokens += tokens.TOKENS_PER_MESSAGE
+            for value in message.values():
+                num_tokens += len(encoding.encode(value))
+        return num_tokens + tokens.TOKENS_PER_REPLY
+
+    while count(messages) > token_limit:
+        messages.pop(1)
+    return count(messages)
+
+
+def measure(func, messages: list) -> tuple[float, int]:
+    messages = list(messages)
+    start = time.perf_counter()
+    num_tokens = func(messages, SMALL_MODEL_TOKEN_LIMIT)
+    return time.perf_counter() - start, num_tokens
+
+
+def main():
+    print(f"{'length':>8} {'naive':>10} {'cold':>10} {'warm':>10} tokens")
+    for length in CHAIN_LENGTHS:
+        messages = make_chain(length)
+        naive_time, naive_tokens = measure(naive_trim, messages)
+        tokens._num_tokens_from_items.cache_clear()
+        cold_time, num_tokens = measure(tokens.trim_messages, messages)
+        warm_time, _ = measure(tokens.trim_messages, messages)
+        assert naive_tokens == num_tokens
+        print(
+            f"{length:>8} {naive_time * 1000:>8.1f}ms {cold_time * 1000:>8.1f}ms"
+            f" {warm_time * 1000:>8.1f}ms {num_tokens}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import glob
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+# 保存しておいた実データを置くディレクトリ
+# pages/*.html: 検索結果のページ、hotpepper/*.json: グルメサーチ API のレスポンス、
+# calendar/*.html: 外為どっとコムの経済指標カレンダー
+CORPUS_DIR = os.environ.get(
+    "BENCH_CORPUS_DIR", os.path.join(os.path.dirname(__file__), "corpus")
+)
+SAMPLE_PHRASES = [
+    "関宮駅から徒歩5分のところにある",
+    "老舗のラーメン屋で",
+    "スープは豚骨と魚介のダブルスープ",
+    "週末は行列ができることもあります",
+    "円相場は米国の雇用統計を受けて",
+    "日銀の金融政策決定会合では",
+    "新作アニメの放送が始まり",
+    "ファンの間で話題になっている",
+]
+COUNTRIES = ["日本", "米国", "ユーロ", "英国", "中国", "豪州"]
+INDICATORS = ["雇用統計", "消費者物価指数", "GDP", "小売売上高", "政策金利", "PMI"]
+
+
+def read_files(kind: str, pattern: str) -> list[tuple[str, str]]:
+    paths = sorted(glob.glob(os.path.join(CORPUS_DIR, kind, pattern)))
+    files = []
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            files.append((os.path.basename(path), f.read()))
+    return files
+
+
+def synthetic_page(paragraphs: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    body = []
+    for _ in range(paragraphs):
+        sentences = [
+            "".join(rng.choices(SAMPLE_PHRASES, k=rng.randint(1, 3))) + "。"
+            for _ in range(rng.randint(2, 6))
+        ]
+        body.append("<p>" + "".join(sentences) + "</p>")
+    return (
+        "<html><head><title>synthetic</title></head><body>"
+        + "<div class='nav'><a href='/'>home</a></div>" * 20
+        + "".join(body)
+        + "</body></html>"
+    )
+
+
+def synthetic_hotpepper_payload(shops: int = 10, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    return {
+        "results": {
+            "api_version": "1.26",
+            "results_available": shops * 10,
+            "results_returned": str(shops),
+            "results_start": 1,
+            "shop": [
+                {
+                    "id": f"J{i:09d}",
+                    "name": f"{rng.choice(SAMPLE_PHRASES)} {i}号店",
+                    "address": f"東京都新宿区西新宿{i}-{i}-{i}",
+                    "budget": {
+                        "code": "B003",
+                        "average": "3000円",
+                        "name": "2001～3000円",
+                    },
+                    "genre": {"code": "G001", "name": "居酒屋", "catch": "飲み放題"},
+                    "open": "月～金、祝前日: 17:00～翌0:00",
+                    "close": "日",
+                    "urls": {"pc": f"https://www.hotpepper.jp/strJ{i:09d}/"},
+                    "catch": rng.choice(SAMPLE_PHRASES),
+                    "photo": {
+                        "pc": {
+                            "l": "https://example.com/l.jpg",
+                            "s": "https://example.com/s.jpg",
+                        },
+                        "mobile": {"l": "https://example.com/l.jpg"},
+                    },
+                    "lat": 35.69 + rng.random() / 100,
+                    "lng": 139.70 + rng.random() / 100,
+                    "station_name": "新宿",
+                    "access": "JR新宿駅西口徒歩5分",
+                }
+                for i in range(shops)
+            ],
+        }
+    }
+
+
+def synthetic_calendar_page(
+    days: int = 7, rows_per_day: int = 30, seed: int = 0
+) -> str:
+    rng = random.Random(seed)
+    weekdays = "月火水木金土日"
+    start = datetime.now()
+    rows = []
+    for d in range(days):
+        day = start + timedelta(days=d)
+        for r in range(rows_per_day):
+            cells = [
+                f"{rng.randint(0, 23):02d}:{rng.choice(['00', '30'])}",
+                rng.choice(COUNTRIES),
+                rng.choice(INDICATORS),
+                "★" * rng.randint(1, 5),
+                "-",
+                "-",
+            ]
+            if r == 0:
+                cells.insert(
+                    0, f"{day.month:02d}/{day.day:02d}({weekdays[day.weekday()]})"
+                )
+            rows.append("<tr>" + "".join(f"<td>{c}</td>" for c in cells) + "</tr>")
+    return (
+        "<html><body><table><tr><th>日付</th><th>時刻</th><th>国</th><th>指標</th>"
+        + "<th>重要度</th></tr>"
+        + "".join(rows)
+        + "</table></body></html>"
+    )
+
+
+def load_pages() -> list[tuple[str, str]]:
+    pages = read_files("pages", "*.html")
+    if pages:
+        return pages
+
+    # コーパスが無ければ合成データで代用する
+    return [(f"synthetic-{n}", synthetic_page(n, seed=n)) for n in [10, 40, 150]]
+
+
+def load_hotpepper_payloads() -> list[tuple[str, dict]]:
+    payloads = [
+        (name, json.loads(text)) for name, text in read_files("hotpepper", "*.json")
+    ]
+    return payloads or [("synthetic", synthetic_hotpepper_payload())]
+
+
+def load_calendar_pages() -> list[tuple[str, str]]:
+    return read_files("calendar", "*.html") or [
+        ("synthetic", synthetic_calendar_page())
+    ]
@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+import time
+import zlib
+from collections import Counter
+
+import corpus
+from aiohttp import web
+
+# 負荷試験で使う外部サービスのスタブ
+# OpenAI、Google カスタム検索、検索結果のページ、ホットペッパー、
+# AWS (SSM、CloudWatch Logs、Location Service) を 1 つのポートでまとめて受ける
+DEFAULT_CONFIG = {
+    # 最初のチャンクが返るまでの秒数と、ストリーミング時のチャンクの間隔
+    "openai_latency": 0.8,
+    "openai_chunk_interval": 0.02,
+    "openai_chunk_size": 8,
+    # 関数を渡されたときに関数呼び出しを返す割合
+    "function_call_rate": 0.3,
+    # 429 を返してリトライさせる割合
+    "openai_error_rate": 0.0,
+    "reply_length": 200,
+    "http_latency": 0.05,
+    "page_paragraphs": [10, 40, 150],
+    "seed": 0,
+}
+REPLY_PHRASES = [
+    "それなら[こちら](https://example.com/guide)が参考になりますよ",
+    "関宮駅の近くにも美味しいお店がありますね",
+    "今日はいい天気ですね(笑)",
+    "円相場の動きが気になるところです",
+    "新作アニメ、私も見ました！",
+]
+TOOL_CALLS = [
+    ("get_search_results", {"query": "関宮 ラーメン"}),
+    (
+        "search_restaurants",
+        {"keyword": "ラーメン", "address": "新宿駅", "is_point": True},
+    ),
+    ("search_restaurants", {"keyword": "焼肉", "address": "渋谷", "is_point": False}),
+    ("get_current_time", {}),
+]
+
+
+def make_app(config: dict) -> web.Application:
+    config = {**DEFAULT_CONFIG, **config}
+    rng = random.Random(config["seed"])
+    counter: Counter = Counter()
+    pages: dict[int, str] = {}
+
+    def reply_text() -> str:
+        text = ""
+        while len(text) < config["reply_length"]:
+            text += rng.choice(REPLY_PHRASES) + "。"
+        return text
+
+    def completion_message(body: dict) -> dict:
+        messages = body.get("messages", [])
+        if (
+            body.get("functions")
+            and messages
+            and messages[-1]["role"] != "function"
+            and rng.random() < config["function_call_rate"]
+        ):
+            name, arguments = rng.choice(TOOL_CALLS)
+            return {
+                "role": "assistant",
+                "content": None,
+                "function_call": {
+                    "name": name,
+                    "arguments": json.dumps(arguments, ensure_ascii=False),
+                },
+            }
+        return {"role": "assistant", "content": reply_text()}
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        counter["openai"] += 1
+        if rng.random() < config["openai_error_rate"]:
+            counter["openai_error"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                status=429,
+            )
+
+        await asyncio.sleep(config["openai_latency"])
+        message = completion_message(body)
+        if "function_call" in message:
+            counter["openai_function_call"] += 1
+        base = {
+            "id": f"chatcmpl-{counter['openai']}",
+            "created": int(time.time()),
+            "model": body["model"],
+        }
+
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [
+                        {"index": 0, "message": message, "finish_reason": "stop"}
+                    ],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0},
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish_reason=None):
+            chunk = {
+                **base,
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        if "function_call" in message:
+            await send({"role": "assistant", "function_call": message["function_call"]})
+        else:
+            content = message["content"]
+            size = config["openai_chunk_size"]
+            for i in range(0, len(content), size):
+                await send({"content": content[i : i + size]})
+                await asyncio.sleep(config["openai_chunk_interval"])
+        await send({}, "stop")
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def custom_search(request: web.Request) -> web.Response:
+        counter["cse"] += 1
+        await asyncio.sleep(config["http_latency"])
+        query = request.query.get("q", "")
+        base_url = f"{request.scheme}://{request.host}"
+        offset = zlib.crc32(query.encode()) % 100
+        items = [
+            {
+                "title": f"{query} の検索結果 {i}",
+                "link": f"{base_url}/pages/{offset + i}",
+                "snippet": rng.choice(corpus.SAMPLE_PHRASES),
+            }
+            for i in range(10)
+        ]
+        return web.json_response({"items": items})
+
+    async def page(request: web.Request) -> web.Response:
+        counter["page"] += 1
+        n = int(request.match_info["n"])
+        etag = f'"page-{n}"'
+        await asyncio.sleep(config["http_latency"])
+        if request.headers.get("If-None-Match") == etag:
+            counter["page_not_modified"] += 1
+            return web.Response(status=304, headers={"ETag": etag})
+
+        if n not in pages:
+            paragraphs = config["page_paragraphs"]
+            pages[n] = corpus.synthetic_page(paragraphs[n % len(paragraphs)], seed=n)
+        return web.Response(
+            text=pages[n],
+            content_type="text/html",
+            charset="utf-8",
+            headers={"ETag": etag},
+        )
+
+    async def hotpepper(request: web.Request) -> web.Response:
+        counter["hotpepper"] += 1
+        await asyncio.sleep(config["http_latency"])
+        return web.json_response(
+            corpus.synthetic_hotpepper_payload(seed=counter["hotpepper"])
+        )
+
+    async def aws_json(request: web.Request) -> web.Response:
+        # JSON プロトコルのサービスは X-Amz-Target で呼び出す操作が分かる
+        target = request.headers.get("X-Amz-Target", "")
+        operation = target.split(".")[-1]
+        counter[f"aws_{operation}"] += 1
+        body = await request.json()
+        await asyncio.sleep(config["http_latency"])
+
+        if operation == "GetParameters":
+            payload = {
+                "Parameters": [
+                    {"Name": name, "Type": "SecureString", "Value": "loadtest"}
+                    for name in body["Names"]
+                ],
+                "InvalidParameters": [],
+            }
+        elif operation == "DescribeLogStreams":
+            payload = {"logStreams": [{"logStreamName": "loadtest"}]}
+        elif operation in ["GetLogEvents", "FilterLogEvents"]:
+            now = int(time.time() * 1000)
+            payload = {
+                "events": [
+                    {
+                        "logStreamName": "loadtest",
+                        "timestamp": now - i * 1000,
+                        "message": f"INFO:__main__:loadtest event {i}",
+                    }
+                    for i in range(body.get("limit", 10))
+                ]
+            }
+        else:
+            return web.json_response(
+                {"__type": "UnknownOperationException"}, status=400
+            )
+        return web.json_response(payload, content_type="application/x-amz-json-1.1")
+
+    async def place_search(request: web.Request) -> web.Response:
+        counter["aws_SearchPlaceIndexForText"] += 1
+        body = await request.json()
+        await asyncio.sleep(config["http_latency"])
+        results = [
+            {
+                "Place": {
+                    "Geometry": {
+                        "Point": [139.70 + rng.random() / 10, 35.69 + rng.random() / 10]
+                    }
+                },
+                "Relevance": 1.0,
+            }
+            for _ in range(3)
+        ]
+        return web.json_response(
+            {
+                "Summary": {"Text": body["Text"], "DataSource": "Esri"},
+                "Results": results,
+            }
+        )
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(dict(counter))
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/customsearch/v1", custom_search)
+    app.router.add_get("/pages/{n}", page)
+    app.router.add_get("/hotpepper/gourmet/v1/", hotpepper)
+    app.router.add_post("/places/v0/indexes/{index}/search/text", place_search)
+    app.router.add_post("/", aws_json)
+    app.router.add_get("/_stats", stats)
+    return app
+
+
+def serve(port: int, config: dict):
+    web.run_app(make_app(config), host="127.0.0.1", port=port, print=None)
+
+
+def find_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start(config: dict, port: int = 0) -> tuple[multiprocessing.Process, str]:
+    # 計測対象と CPU やメモリを取り合わないよう別プロセスで動かす
+    port = port or find_free_port()
+    process = multiprocessing.Process(target=serve, args=(port, config), daemon=True)
+    process.start()
+
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline or not process.is_alive():
+                process.terminate()
+                raise RuntimeError("Fake services did not start")
+            time.sleep(0.05)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="負荷試験用の外部サービスのスタブ")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--config", default="{}", help="DEFAULT_CONFIG を上書きする JSON")
+    args = parser.parse_args()
+    print(f"Listening on http://127.0.0.1:{args.port}")
+    serve(args.port, json.loads(args.config))
+
+
+if __name__ == "__main__":
+    main()
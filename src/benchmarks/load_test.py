@@ -0,0 +1,440 @@
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import resource
+import sys
+import time
+import urllib.request
+from collections import Counter
+from types import SimpleNamespace
+from typing import Optional
+
+import discord
+import fake_services
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PROMPTS = [
+    "おすすめのラーメン屋を教えて",
+    "新宿駅の近くで焼肉が食べたい",
+    "今何時？",
+    "今日のニュースを調べて",
+    "最近見たアニメの話をしよう",
+]
+SPOILER_CHANNEL_NAMES = [f"anime-{i:03d}" for i in range(50)]
+
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "chatbot"))
+
+logger = logging.getLogger("load_test")
+snowflakes = itertools.count(1 << 40)
+discord_calls: Counter = Counter()
+
+
+# Discord の代わりに、API 呼び出しごとに latency 秒待つだけの偽物を使う
+class FakeUser:
+    def __init__(self, name: str):
+        self.id = next(snowflakes)
+        self.name = name
+
+    def mentioned_in(self, message) -> bool:
+        return self in message.mentions
+
+
+class FakeChannel:
+    def __init__(self, bot_user: FakeUser, latency: float):
+        self.id = next(snowflakes)
+        self.bot_user = bot_user
+        self.latency = latency
+        self.messages: dict[int, FakeMessage] = {}
+        # 返信先のメッセージ ID -> 関宮AI が最後に送ったメッセージ
+        self.replies: dict[int, FakeMessage] = {}
+        self.tips: list[FakeMessage] = []
+
+    async def api_call(self, name: str):
+        discord_calls[name] += 1
+        await asyncio.sleep(self.latency)
+
+    async def send(self, content: str, reference=None):
+        await self.api_call("send")
+        message = FakeMessage(self, self.bot_user, content, reference)
+        if reference is not None:
+            self.replies[reference.id] = message
+        return message
+
+    async def fetch_message(self, message_id: int):
+        await self.api_call("fetch_message")
+        if message_id not in self.messages:
+            response = SimpleNamespace(status=404, reason="Not Found")
+            raise discord.NotFound(response, "Unknown Message")
+        return self.messages[message_id]
+
+
+class FakeMessage:
+    def __init__(
+        self,
+        channel: FakeChannel,
+        author: FakeUser,
+        content: str,
+        reference: Optional["FakeMessage"] = None,
+        mentions: tuple = (),
+    ):
+        self.id = next(snowflakes)
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.reference = None
+        if reference is not None:
+            self.reference = SimpleNamespace(message_id=reference.id, resolved=None)
+        self.mentions = list(mentions)
+        channel.messages[self.id] = self
+
+    async def edit(self, content: str):
+        await self.channel.api_call("edit")
+        self.content = content
+        return self
+
+    async def delete(self):
+        await self.channel.api_call("delete")
+        self.channel.messages.pop(self.id, None)
+
+
+class FakeGuildChannel:
+    def __init__(self, name: str, position: int, latency: float):
+        self.id = next(snowflakes)
+        self.name = name
+        self.position = position
+        self.latency = latency
+
+    def overwrites_for(self, member) -> discord.PermissionOverwrite:
+        return discord.PermissionOverwrite()
+
+    async def set_permissions(self, member, overwrite):
+        discord_calls["set_permissions"] += 1
+        await asyncio.sleep(self.latency)
+
+
+class FakeResponse:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def send_message(self, content: str, ephemeral: bool = False):
+        discord_calls["interaction_response"] += 1
+        await asyncio.sleep(self.latency)
+
+    async def defer(self, ephemeral: bool = False):
+        discord_calls["interaction_defer"] += 1
+        await asyncio.sleep(self.latency)
+
+
+class FakeFollowup:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def send(self, content: str, ephemeral: bool = False):
+        discord_calls["interaction_followup"] += 1
+        await asyncio.sleep(self.latency)
+
+
+def configure_environment(base_url: str, stream: bool):
+    # 外部サービスはすべてスタブに向ける。本物の認証情報は使わない
+    os.environ.update(
+        {
+            "AWS_ACCESS_KEY_ID": "loadtest",
+            "AWS_SECRET_ACCESS_KEY": "loadtest",
+            "AWS_DEFAULT_REGION": "us-west-2",
+            "AWS_ENDPOINT_URL_SSM": base_url,
+            "AWS_ENDPOINT_URL_CLOUDWATCH_LOGS": base_url,
+            "LOCATION_ENDPOINT_URL": base_url,
+            "GOOGLE_API_ENDPOINT": base_url + "/",
+            "HOTPEPPER_API_URL": base_url + "/hotpepper/gourmet/v1/",
+            "OPENAI_API_BASE": base_url + "/v1",
+            "STREAM_REPLIES": str(stream).lower(),
+        }
+    )
+    os.environ.setdefault("CHARACTER_SETTING", "あなたは関宮AIです。")
+    os.environ.setdefault("LOG_GROUP_NAME", "loadtest")
+
+
+def build_world(bot, args, rng: random.Random) -> SimpleNamespace:
+    bot_user = FakeUser("sekimiya-ai")
+    bot.discord_client._connection.user = bot_user
+    users = [FakeUser(f"user-{i}") for i in range(args.users)]
+    channels = [
+        FakeChannel(bot_user, args.discord_latency) for _ in range(args.channels)
+    ]
+
+    # 各チャンネルにユーザーと関宮AIが交互に返信し合った長い会話を用意しておく
+    for channel in channels:
+        for _ in range(args.chains):
+            message = None
+            for depth in range(args.chain_depth):
+                author = bot_user if depth % 2 else rng.choice(users)
+                content = rng.choice(PROMPTS) * rng.randint(1, 4)
+                message = FakeMessage(channel, author, content, message)
+                if args.warm_cache:
+                    bot.message_cache.remember(message, bot.get_role)
+            if message is not None:
+                channel.tips.append(message)
+
+    spoiler_category = SimpleNamespace(
+        name="SPOILERS",
+        channels=[
+            FakeGuildChannel(name, position, args.discord_latency)
+            for position, name in enumerate(SPOILER_CHANNEL_NAMES)
+        ],
+    )
+    guild = SimpleNamespace(
+        id=next(snowflakes),
+        categories=[SimpleNamespace(name="General", channels=[]), spoiler_category],
+    )
+    return SimpleNamespace(
+        bot_user=bot_user, users=users, channels=channels, guild=guild
+    )
+
+
+async def send_message(bot, world, args, rng: random.Random, i: int) -> str:
+    channel = rng.choice(world.channels)
+    reference = None
+    if channel.tips and rng.random() < args.reply_ratio:
+        tip = rng.randrange(len(channel.tips))
+        reference = channel.tips[tip]
+
+    content = f"<@{world.bot_user.id}> {rng.choice(PROMPTS)} #{i}"
+    message = FakeMessage(
+        channel, rng.choice(world.users), content, reference, (world.bot_user,)
+    )
+    await bot.on_message(message)
+
+    if reference is None:
+        return "message"
+    # 返事にさらに返信していくので、会話はどんどん深くなる
+    if message.id in channel.replies:
+        channel.tips[tip] = channel.replies[message.id]
+    return "reply"
+
+
+async def run_slash_command(bot, world, args, rng: random.Random) -> str:
+    interaction = SimpleNamespace(
+        guild=world.guild,
+        user=rng.choice(world.users),
+        response=FakeResponse(args.discord_latency),
+        followup=FakeFollowup(args.discord_latency),
+    )
+    command = rng.choice(
+        ["list-spoiler-channels", "join-spoiler-channel", "logs", "stats", "memory"]
+    )
+    if command == "join-spoiler-channel" and rng.random() < 0.5:
+        # 入力中の名前の候補を出すだけのリクエスト
+        prefix = rng.choice(SPOILER_CHANNEL_NAMES)[: rng.randint(0, 8)]
+        await bot.spoiler_channel_autocomplete(interaction, prefix)
+        return "/join (autocomplete)"
+    if command == "list-spoiler-channels":
+        await bot.list_spoiler_channels.callback(interaction)
+    elif command == "join-spoiler-channel":
+        channel_name = rng.choice(SPOILER_CHANNEL_NAMES)
+        await bot.join_spoiler_channels.callback(interaction, channel_name)
+    elif command == "logs":
+        # 手元のログで足りる場合と、CloudWatch まで見に行く場合の両方を混ぜる
+        if rng.random() < 0.5:
+            await bot.fetch_bot_logs.callback(interaction, 10)
+        else:
+            await bot.fetch_bot_logs.callback(interaction, 10, "ERROR", hours=6)
+    elif command == "memory":
+        await bot.show_memory.callback(interaction)
+    else:
+        await bot.show_stats.callback(interaction)
+    return "/" + command
+
+
+async def monitor_loop_lag(interval: float, lags: list, stop: asyncio.Event):
+    # sleep が予定よりどれだけ遅れて戻ってきたかをイベントループの遅延とみなす
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run_load(bot, world, args) -> dict:
+    rng = random.Random(args.seed)
+    numbers = itertools.count()
+    latencies: dict[str, list] = {}
+    errors: Counter = Counter()
+    lags: list[float] = []
+    stop = asyncio.Event()
+
+    async def worker():
+        while (i := next(numbers)) < args.requests:
+            start = time.perf_counter()
+            try:
+                if rng.random() < args.slash_ratio:
+                    kind = await run_slash_command(bot, world, args, rng)
+                else:
+                    kind = await send_message(bot, world, args, rng, i)
+            except Exception as e:
+                logger.exception("Load test request failed")
+                errors[type(e).__name__] += 1
+                continue
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    monitor = asyncio.create_task(monitor_loop_lag(args.lag_interval, lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor
+
+    return {"elapsed": elapsed, "latencies": latencies, "errors": errors, "lags": lags}
+
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * p / 100) - 1)]
+
+
+def summarize(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def peak_rss_mb() -> float:
+    # Linux の ru_maxrss は KiB 単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fetch_service_stats(base_url: str) -> dict:
+    with urllib.request.urlopen(base_url + "/_stats") as res:
+        return json.load(res)
+
+
+def print_report(report: dict):
+    print(
+        f"\nconcurrency={report['concurrency']} requests={report['requests']}"
+        f" elapsed={report['elapsed']:.2f}s"
+        f" throughput={report['throughput']:.2f} req/s"
+        f" errors={report['errors']}"
+    )
+    print(f"\n{'kind':<24} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    rows = {**report["latency"], "event loop lag": report["loop_lag"]}
+    for kind, stats in rows.items():
+        if not stats["count"]:
+            continue
+        print(
+            f"{kind:<24} {stats['count']:>6}"
+            + "".join(
+                f" {stats[key] * 1000:>7.1f}ms" for key in ["p50", "p95", "p99", "max"]
+            )
+        )
+    print(
+        f"\nstartup={report['startup_seconds']:.2f}s"
+        f" rss_after_startup={report['rss_after_startup_mb']:.1f}MiB"
+        f" peak_rss={report['peak_rss_mb']:.1f}MiB"
+    )
+    print(f"scheduler: {report['scheduler']}")
+    print(f"discord: {report['discord']}")
+    print(f"services: {report['services']}")
+    print("\n" + "\n".join(report["memory"]))
+    if report["top_allocations"]:
+        print("\n" + "\n".join(report["top_allocations"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="関宮AI の負荷試験 (外部サービスはすべてスタブ)")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("-n", "--requests", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--chains", type=int, default=5, help="チャンネルごとの会話の数")
+    parser.add_argument("--chain-depth", type=int, default=50)
+    parser.add_argument("--reply-ratio", type=float, default=0.5)
+    parser.add_argument("--slash-ratio", type=float, default=0.05)
+    parser.add_argument("--warm-cache", action="store_true", help="会話を最初からキャッシュに載せておく")
+    parser.add_argument("--no-stream", dest="stream", action="store_false")
+    parser.add_argument("--discord-latency", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=0.8)
+    parser.add_argument("--openai-chunk-interval", type=float, default=0.02)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--function-call-rate", type=float, default=0.3)
+    parser.add_argument("--http-latency", type=float, default=0.05)
+    parser.add_argument("--lag-interval", type=float, default=0.01)
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--log-file", default=os.devnull, help="ボットのログの出力先")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--tracemalloc", action="store_true", help="負荷をかけている間のメモリの確保元を記録する"
+    )
+    parser.add_argument("--output", help="結果を JSON で保存する")
+    args = parser.parse_args()
+
+    process, base_url = fake_services.start(
+        {
+            "openai_latency": args.openai_latency,
+            "openai_chunk_interval": args.openai_chunk_interval,
+            "openai_error_rate": args.openai_error_rate,
+            "function_call_rate": args.function_call_rate,
+            "http_latency": args.http_latency,
+            "seed": args.seed,
+        }
+    )
+    try:
+        configure_environment(base_url, args.stream)
+        start = time.perf_counter()
+        bot = importlib.import_module("main")
+        # ログの整形や書き込みのコストは含めたいが、画面は埋めたくない
+        bot.logs.setup_logging(
+            args.log_level, logging.FileHandler(args.log_file, mode="w")
+        )
+        bot.load_parameters()
+        # setup_hook と同じく、トークナイザーと CPU 用のプロセスを用意してから流す
+        bot.warm_up()
+        startup_seconds = time.perf_counter() - start
+        rss_after_startup = peak_rss_mb()
+
+        world = build_world(bot, args, random.Random(args.seed))
+        if args.tracemalloc:
+            bot.memory_usage.start_tracing()
+        result = asyncio.run(run_load(bot, world, args))
+
+        completed = sum(len(values) for values in result["latencies"].values())
+        report = {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "elapsed": result["elapsed"],
+            "throughput": completed / result["elapsed"],
+            "errors": dict(result["errors"]),
+            "latency": {
+                kind: summarize(values)
+                for kind, values in sorted(result["latencies"].items())
+            },
+            "loop_lag": summarize(result["lags"]),
+            "startup_seconds": startup_seconds,
+            "rss_after_startup_mb": rss_after_startup,
+            "peak_rss_mb": peak_rss_mb(),
+            "memory": bot.memory_usage.rss_lines(),
+            "top_allocations": bot.memory_usage.top_allocations(15),
+            "scheduler": dict(bot.scheduler.counter),
+            "discord": dict(discord_calls),
+            "services": fetch_service_stats(base_url),
+        }
+    finally:
+        process.terminate()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), **report}, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
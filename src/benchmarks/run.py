@@ -0,0 +1,208 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from collections.abc import Callable
+from functools import partial
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+# 前回より中央値がこれ以上遅くなったものを回帰として扱う
+REGRESSION_THRESHOLD = 1.1
+
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "chatbot"))
+os.environ.setdefault("CHANNEL_ID", "0")
+os.environ.setdefault("IMPORTANCE_LEVEL", "0")
+
+import corpus  # noqa: E402
+import reply  # noqa: E402
+import tokens  # noqa: E402
+from bench_tokens import make_chain  # noqa: E402
+from functions import browser, restaurants  # noqa: E402
+
+
+def load_post_indicators():
+    # チャットボットの main.py と名前が被るので別名で読み込む
+    spec = importlib.util.spec_from_file_location(
+        "post_indicators_main",
+        os.path.join(BENCHMARK_DIR, "..", "post_indicators", "main.py"),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def token_cases() -> dict[str, Callable]:
+    chain = make_chain(500)
+
+    def count_cold():
+        tokens._num_tokens_from_items.cache_clear()
+        tokens.num_tokens_from_messages(chain)
+
+    def trim_warm():
+        tokens.trim_messages(list(chain), 1024 * 4 * 0.9)
+
+    return {
+        "tokens.num_tokens_from_messages[cold,500]": count_cold,
+        "tokens.trim_messages[warm,500]": trim_warm,
+    }
+
+
+def style_cases() -> dict[str, Callable]:
+    text = "これは[リンク](https://example.com)です(笑)！ほんと？ｗ♪\n" * 3000
+
+    def feed_incrementally():
+        styler = reply.IncrementalStyler()
+        for i in range(0, len(text), 8):
+            styler.feed(text[i : i + 8])
+        styler.flush()
+
+    return {
+        f"reply.modify_text_style[{len(text)}]": partial(reply.modify_text_style, text),
+        f"reply.IncrementalStyler[{len(text)}]": feed_incrementally,
+    }
+
+
+def browser_cases() -> dict[str, Callable]:
+    cases = {}
+    for name, html in corpus.load_pages():
+        cases[f"browser.extract_text[{name}]"] = partial(browser.extract_text, html)
+        cases[f"browser.summarize_html[{name}]"] = partial(browser.summarize_html, html)
+    return cases
+
+
+def restaurant_cases() -> dict[str, Callable]:
+    return {
+        f"restaurants.optimize_response[{name}]": partial(
+            restaurants.optimize_response, payload
+        )
+        for name, payload in corpus.load_hotpepper_payloads()
+    }
+
+
+def indicator_cases() -> dict[str, Callable]:
+    post_indicators = load_post_indicators()
+    return {
+        f"post_indicators.parse_indicators[{name}]": partial(
+            post_indicators.parse_indicators, content.encode("utf-8")
+        )
+        for name, content in corpus.load_calendar_pages()
+    }
+
+
+def collect_cases() -> dict[str, Callable]:
+    cases = {}
+    for make_cases in [
+        token_cases,
+        style_cases,
+        browser_cases,
+        restaurant_cases,
+        indicator_cases,
+    ]:
+        cases.update(make_cases())
+    return cases
+
+
+def measure(func: Callable, repeat: int, min_time: float) -> dict:
+    # 1 回が短すぎるものは min_time を超えるまでまとめて回して 1 回あたりに直す
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= min_time or number >= 1 << 20:
+            break
+        number *= 2
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCHMARK_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(baseline: dict, results: dict) -> int:
+    regressions = 0
+    print(f"\n{'benchmark':<56} {'base':>10} {'now':>10} {'ratio':>7}")
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]["median"]
+        ratio = result["median"] / base
+        mark = ""
+        if ratio > REGRESSION_THRESHOLD:
+            mark = " !"
+            regressions += 1
+        print(
+            f"{name[:56]:<56} {base * 1000:>8.3f}ms"
+            f" {result['median'] * 1000:>8.3f}ms {ratio:>6.2f}x{mark}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="関宮AI のマイクロベンチマーク")
+    parser.add_argument("-k", "--filter", default="", help="名前に含む文字列で絞り込む")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--compare", help="比較対象の結果ファイル")
+    parser.add_argument("--output", help="結果の保存先 (既定: results/<commit>.json)")
+    args = parser.parse_args()
+
+    commit = current_commit()
+    results = {
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": {},
+    }
+
+    for name, func in collect_cases().items():
+        if args.filter not in name:
+            continue
+        result = measure(func, args.repeat, args.min_time)
+        results["results"][name] = result
+        print(f"{name[:56]:<56} {result['median'] * 1000:>10.3f}ms")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"\nSaved: {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CHATBOT_DIR = os.path.join(BENCHMARK_DIR, "..", "chatbot")
+# 起動時には読まず、初めて使うときに読み込むもの
+LAZY_MODULES = ["googleapiclient.discovery", "sumy.summarizers.lex_rank", "boto3"]
+
+# 子プロセスで毎回まっさらな状態から計測する
+CHILD_SCRIPT = f"""
+import importlib
+import json
+import sys
+import time
+
+timings = {{}}
+start = time.perf_counter()
+import main
+timings["import main"] = time.perf_counter() - start
+
+# main がすでに読み込んでいると、遅延読み込みの計測が 0 になって見落とす
+loaded = [module for module in {LAZY_MODULES!r} if module in sys.modules]
+if loaded:
+    sys.exit("imported by main at startup: " + ", ".join(loaded))
+
+start = time.perf_counter()
+main.get_encoding()
+timings["load tiktoken encoding"] = time.perf_counter() - start
+
+for module in {LAZY_MODULES!r}:
+    start = time.perf_counter()
+    importlib.import_module(module)
+    timings["import " + module + " (lazy)"] = time.perf_counter() - start
+
+print(json.dumps(timings))
+"""
+
+
+def child_env() -> dict:
+    env = dict(os.environ)
+    env.setdefault("CHARACTER_SETTING", "あなたは関宮AIです。")
+    env.setdefault("LOG_GROUP_NAME", "startup")
+    return env
+
+
+def run_child(importtime: bool = False) -> subprocess.CompletedProcess:
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    result = subprocess.run(
+        command + ["-c", CHILD_SCRIPT],
+        cwd=CHATBOT_DIR,
+        env=child_env(),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+    return result
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int]]:
+    # "import time: self [us] | cumulative | imported package" の形式
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        modules.append((name.rstrip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def depth(name: str) -> int:
+    # 名前の前の空白 1 つに加えて、ネストが 1 段深くなるごとに空白が 2 つ増える
+    return (len(name) - len(name.lstrip()) - 1) // 2
+
+
+def children_of(modules: list, parent: str) -> list:
+    # -X importtime は子を親より先に出すので、親の行の手前を遡る
+    children = []
+    for i, (name, _, _) in enumerate(modules):
+        if name.strip() == parent and depth(name) == 0:
+            for module in reversed(modules[:i]):
+                if depth(module[0]) == 0:
+                    break
+                if depth(module[0]) == 1:
+                    children.append(module)
+            break
+    return children
+
+
+def main():
+    parser = argparse.ArgumentParser(description="関宮AI の起動時間の内訳")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--output", help="結果を JSON で保存する")
+    args = parser.parse_args()
+
+    runs = [json.loads(run_child().stdout) for _ in range(args.repeat)]
+    timings = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+    print(f"{'stage':<48} {'median':>10}")
+    for name, seconds in timings.items():
+        print(f"{name:<48} {seconds * 1000:>8.1f}ms")
+
+    # -X importtime 自体にもオーバーヘッドがあるので、内訳は別に 1 回だけ取る
+    modules = parse_importtime(run_child(importtime=True).stderr)
+    print(f"\n{'imported by main':<48} {'cumulative':>10}")
+    for name, _, cumulative_us in sorted(
+        children_of(modules, "main"), key=lambda m: -m[2]
+    )[: args.top]:
+        print(f"{name.strip():<48} {cumulative_us / 1000:>8.1f}ms")
+    print(f"\n{'module':<48} {'self':>10}")
+    for name, self_us, _ in sorted(modules, key=lambda m: -m[1])[: args.top]:
+        print(f"{name.strip():<48} {self_us / 1000:>8.1f}ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "timings": timings,
+                    "imports": [
+                        {"module": name.strip(), "self_us": s, "cumulative_us": c}
+                        for name, s, c in modules
+                    ],
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
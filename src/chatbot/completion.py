@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import random
+from collections.abc import AsyncIterator, Awaitable, Callable
+from typing import Optional
+
+import aiohttp
+import metrics
+import openai
+
+OPENAI_REQUEST_TIMEOUT = float(os.environ.get("OPENAI_REQUEST_TIMEOUT", "60"))
+OPENAI_MAX_RETRY = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 20.0
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempt: int) -> float:
+    # full jitter: 同時に失敗したリクエストが一斉に再送しないようにばらけさせる
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+async def with_retry(request: Callable[[], Awaitable], max_retry: int, timeout: float):
+    for i in range(max_retry):
+        try:
+            return await asyncio.wait_for(request(), timeout=timeout)
+        except asyncio.TimeoutError:
+            error = openai.error.Timeout(f"Request timed out after {timeout} seconds")
+        except openai.error.OpenAIError as e:
+            error = e
+
+        logger.error("Error on retry " + str(i) + ": " + str(error))
+        if i == max_retry - 1:
+            raise error
+
+        metrics.increment("openai.retries")
+        delay = backoff_delay(i)
+        logger.info(f"Retrying after {delay:.1f} seconds...")
+        await asyncio.sleep(delay)
+
+
+async def create_chat_completion(
+    max_retry: int = OPENAI_MAX_RETRY,
+    timeout: float = OPENAI_REQUEST_TIMEOUT,
+    **kwargs,
+) -> dict:
+    return await with_retry(
+        lambda: openai.ChatCompletion.acreate(request_timeout=timeout, **kwargs),
+        max_retry,
+        timeout,
+    )
+
+
+async def stream_chat_completion(
+    max_retry: int = OPENAI_MAX_RETRY,
+    timeout: float = OPENAI_REQUEST_TIMEOUT,
+    **kwargs,
+) -> AsyncIterator[dict]:
+    # 最初のチャンクが届くまではリトライできるが、それ以降は途中から再送できない
+    # timeout はチャンクとチャンクの間隔に対してかける
+    async def start():
+        chunks = await openai.ChatCompletion.acreate(
+            stream=True, request_timeout=timeout, **kwargs
+        )
+        return chunks, await next_chunk(chunks)
+
+    chunks, chunk = await with_retry(start, max_retry, timeout)
+    while True:
+        yield chunk
+        try:
+            chunk = await asyncio.wait_for(next_chunk(chunks), timeout=timeout)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            raise openai.error.Timeout(f"Stream stalled for {timeout} seconds")
+
+
+async def next_chunk(chunks: AsyncIterator[dict]) -> dict:
+    # openai はストリームを読んでいる途中の aiohttp の例外を包まないので、ここで包む
+    try:
+        return await chunks.__anext__()
+    except aiohttp.ClientError as e:
+        raise openai.error.APIConnectionError(f"Stream interrupted: {e!r}") from e
+
+
+async def create_chat_message(
+    on_text: Optional[Callable[[str], Awaitable]] = None, **kwargs
+) -> dict:
+    if on_text is None:
+        response = await create_chat_completion(**kwargs)
+        return response["choices"][0]["message"]
+
+    # ストリーミング時は差分を on_text に渡しつつ、通常と同じ形のメッセージに組み立てる
+    message = {"role": "assistant", "content": ""}
+    async for chunk in stream_chat_completion(**kwargs):
+        delta = chunk["choices"][0]["delta"]
+        if delta.get("content"):
+            message["content"] += delta["content"]
+            await on_text(delta["content"])
+        if "function_call" in delta:
+            function_call = message.setdefault(
+                "function_call", {"name": "", "arguments": ""}
+            )
+            function_call["name"] += delta["function_call"].get("name", "")
+            function_call["arguments"] += delta["function_call"].get("arguments", "")
+
+    return message
@@ -0,0 +1,77 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections.abc import Callable
+from multiprocessing.pool import Pool
+from typing import Any, Optional
+
+import metrics
+
+# 要約など、GIL を長く握る処理を動かすプロセスの数
+# Fargate の cpu: 256 (0.25 vCPU) なら 1 で足りる。0 なら呼び出し元のスレッドで動かす
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", "1"))
+# タスクが動き始めてからの制限時間。空きプロセスを待つ時間は含めない
+CPU_TASK_TIMEOUT = float(os.environ.get("CPU_TASK_TIMEOUT", "10"))
+# 要約器などが溜め込んだメモリを返すため、この件数ごとにプロセスを作り直す
+MAX_TASKS_PER_WORKER = 100
+
+logger = logging.getLogger(__name__)
+# 空いているワーカー。取り出したスレッドだけがタスクを投げるので、同時に動くのは CPU_WORKERS 件まで
+idle_workers: queue.SimpleQueue[Pool] = queue.SimpleQueue()
+started = False
+start_lock = threading.Lock()
+
+
+def new_worker() -> Pool:
+    # ボットのプロセスはスレッドを抱えているので fork しない
+    # forkserver に cpu_worker を読み込ませておき、ワーカーはそこから fork する
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["cpu_worker"])
+    # 止まらなくなったものだけ捨てられるよう、1 プロセスずつの Pool にする
+    return context.Pool(1, maxtasksperchild=MAX_TASKS_PER_WORKER)
+
+
+def start():
+    global started
+    with start_lock:
+        if started or CPU_WORKERS <= 0:
+            return
+        for _ in range(CPU_WORKERS):
+            idle_workers.put(new_worker())
+        started = True
+
+
+def run(
+    func: Callable,
+    *args,
+    timeout: float = CPU_TASK_TIMEOUT,
+    deadline: Optional[float] = None,
+) -> Any:
+    # 呼び出し元 (ツール用のスレッド) は結果が出るまで待つ
+    if CPU_WORKERS <= 0:
+        return func(*args)
+
+    start()
+    wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+    try:
+        with metrics.timer("stage.cpu_queue_wait"):
+            worker = idle_workers.get(timeout=wait)
+    except queue.Empty:
+        metrics.increment("cpu_pool.queue_timeouts")
+        raise TimeoutError(f"No CPU worker became free for {func.__name__}")
+
+    try:
+        with metrics.timer("stage.cpu_task"):
+            return worker.apply_async(func, args).get(timeout)
+    except multiprocessing.TimeoutError:
+        # 動いているタスクは止められないので、このプロセスだけ捨てて作り直す
+        metrics.increment("cpu_pool.timeouts")
+        logger.error("CPU task %s timed out after %s seconds", func.__name__, timeout)
+        worker.terminate()
+        worker = new_worker()
+        raise
+    finally:
+        idle_workers.put(worker)
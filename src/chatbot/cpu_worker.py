@@ -0,0 +1,8 @@
+# cpu_pool のプロセスの入口。forkserver が一度だけ読み込み、ワーカーはそこから fork する
+# ボット本体 (main.py) は読み込まないので、discord や OpenAI のクライアントは持たない
+import logs
+from functions import browser
+
+logs.setup_worker_logging()
+# 最初のタスクを待たせないよう、トークナイザーと要約器を先に読み込んでおく
+browser.preload()
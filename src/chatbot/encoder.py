@@ -0,0 +1,12 @@
+from functools import lru_cache
+
+import tiktoken  # type: ignore[import]
+
+ENCODING_MODEL = "gpt-3.5-turbo"
+
+
+@lru_cache(maxsize=None)
+def get_encoding() -> tiktoken.Encoding:
+    # BPE ファイルの読み込みに時間がかかるので、プロセスで 1 回だけ、使うときに読む
+    # イメージには TIKTOKEN_CACHE_DIR に焼き込んであるので、起動時にダウンロードはしない
+    return tiktoken.encoding_for_model(ENCODING_MODEL)
@@ -1,36 +1,55 @@
 import json
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Optional
 
-import requests
-import tiktoken
-from bs4 import BeautifulSoup
-from googleapiclient.discovery import build
-from sumy.nlp.tokenizers import Tokenizer
-from sumy.parsers.plaintext import PlaintextParser
-from sumy.summarizers.lex_rank import LexRankSummarizer
+import cpu_pool
+from encoder import get_encoding
+from functions import cache
+
+FETCH_WORKERS = 10
+FETCH_DEADLINE = 15
+SEARCH_CACHE_TTL = 60 * 60 * 6
+# 要約は SUMMARY_FRESH_TTL の間はそのまま使い、それを過ぎたら ETag などで再検証する
+SUMMARY_FRESH_TTL = 60 * 60
+SUMMARY_CACHE_TTL = 60 * 60 * 24 * 7
+SUMMARY_TOKEN_LIMIT = 1024 * 4
+# 要約の元にするのはページ先頭からこのトークン数まで
+EXTRACT_TOKEN_LIMIT = SUMMARY_TOKEN_LIMIT * 8
+# "numpy" は functions/summarizer.py、"lexrank" は sumy の LexRankSummarizer を使う
+SUMMARIZER = os.environ.get("SUMMARIZER", "numpy")
+# 負荷試験などでローカルのスタブに向けるときだけ設定する
+GOOGLE_API_ENDPOINT = os.environ.get("GOOGLE_API_ENDPOINT")
 
-encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
 logger = logging.getLogger(__name__)
+fetch_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+search_cache = cache.make_cache("search", maxsize=256, ttl=SEARCH_CACHE_TTL)
+summary_cache = cache.make_cache("summary", maxsize=1024, ttl=SUMMARY_CACHE_TTL)
 
 
 def fetch_search_result(
     query: str, start_index: int = 1, token_limit: int = 1024 * 8
 ) -> str:
     result = []
-    service = build(
-        "customsearch",
-        "v1",
-        cache_discovery=False,
-        developerKey=os.environ["GCP_API_KEY"],
-    )
-    search_result = (
-        service.cse()
-        .list(q=query, cx=os.environ["GOOGLE_CSE_KEY"], num=10, start=start_index)
-        .execute()
-    )
+    search_result = search(query, start_index)
+
+    # ページの取得は並列に行い、締め切りに間に合わなかったものは捨てる
+    items = search_result["items"]
+    deadline = time.monotonic() + FETCH_DEADLINE
+    futures = [
+        fetch_executor.submit(fetch_website_summary, item["link"], deadline=deadline)
+        for item in items
+    ]
+    done, _ = wait(futures, timeout=FETCH_DEADLINE)
+
+    for item, future in zip(items, futures):
+        if future not in done:
+            future.cancel()
+            logger.info("Fetch deadline exceeded: %s", item["link"])
+            continue
 
-    for item in search_result["items"]:
         res_item = {
             "title": item["title"],
             "link": item["link"],
@@ -41,41 +60,204 @@ def fetch_search_result(
             pass
 
         try:
-            res_item["summary"] = fetch_website_summary(item["link"])
+            res_item["summary"] = future.result()
         except Exception as e:
             logger.error(e)
             pass
 
         result.append(res_item)
 
-        if len(encoding.encode(json.dumps(result, ensure_ascii=False))) > token_limit:
-            result.pop()
-            break
+    logger.info("Cache stats: %s", cache.stats())
+    return json.dumps(pack_results(result, token_limit), ensure_ascii=False)
 
-    return json.dumps(result, ensure_ascii=False)
 
+def num_tokens_from_item(item: dict) -> int:
+    # ", " の区切り分を 1 トークンとして足しておく
+    return len(get_encoding().encode(json.dumps(item, ensure_ascii=False))) + 1
 
-def fetch_website_summary(url: str, sentences_count: int = 100) -> str:
+
+def pack_results(items: list, token_limit: int) -> list:
+    # 各要素のトークン数は一度だけ数えて足し合わせる
+    # 入りきらない要素は要約を残りの予算まで削って入れ、そこで打ち切る
+    result = []
+    num_tokens = 2  # "[" と "]"
+
+    for item in items:
+        item_tokens = num_tokens_from_item(item)
+        if num_tokens + item_tokens <= token_limit:
+            result.append(item)
+            num_tokens += item_tokens
+            continue
+
+        shrunk_item = shrink_summary(item, token_limit - num_tokens)
+        if shrunk_item is not None:
+            result.append(shrunk_item)
+        break
+
+    return result
+
+
+def shrink_summary(item: dict, budget: int, max_attempts: int = 3) -> Optional[dict]:
+    summary = item.get("summary")
+    base_tokens = num_tokens_from_item({**item, "summary": ""})
+    if not summary or base_tokens >= budget:
+        return None
+
+    encoding = get_encoding()
+    summary_tokens = encoding.encode(summary)
+    keep = len(summary_tokens)
+    for _ in range(max_attempts):
+        item_tokens = num_tokens_from_item(item)
+        if item_tokens <= budget:
+            return item
+
+        # エスケープ分があるので、超過分を要約の長さに比例させて削る
+        summary_cost = item_tokens - base_tokens
+        keep -= (item_tokens - budget) * keep // summary_cost + 1
+        if keep <= 0:
+            return None
+        # 途中で切れたマルチバイト文字の残骸は落とす
+        summary = encoding.decode(summary_tokens[:keep]).rstrip("\ufffd")
+        item = {**item, "summary": summary}
+
+    return item if num_tokens_from_item(item) <= budget else None
+
+
+def search(query: str, start_index: int = 1) -> dict:
+    key = cache.make_key(query, start_index)
+    search_result = search_cache.get(key)
+    if search_result is not None:
+        return search_result
+
+    # googleapiclient は読み込みが重いので、初めて検索するときに読む
+    from googleapiclient.discovery import build
+
+    service = build(
+        "customsearch",
+        "v1",
+        cache_discovery=False,
+        developerKey=os.environ["GCP_API_KEY"],
+        client_options={"api_endpoint": GOOGLE_API_ENDPOINT}
+        if GOOGLE_API_ENDPOINT
+        else None,
+    )
+    search_result = (
+        service.cse()
+        .list(q=query, cx=os.environ["GOOGLE_CSE_KEY"], num=10, start=start_index)
+        .execute()
+    )
+    search_cache.set(key, search_result)
+    return search_result
+
+
+def fetch_website_summary(
+    url: str, sentences_count: int = 100, deadline: Optional[float] = None
+) -> str:
     if url.endswith(".pdf"):
         return ""
 
-    logger.info("Fetch: " + url)
-    res = requests.get(url)
-    soup = BeautifulSoup(res.text, "html.parser")
+    key = cache.make_key(url, sentences_count)
+    cached = summary_cache.get(key)
+    headers = {}
+    if cached is not None:
+        if time.time() - cached["fetched_at"] < SUMMARY_FRESH_TTL:
+            return cached["summary"]
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    # requests と lxml は読み込みが重いので、初めてページを読むときに読む
+    from functions import extractor, http_client
+
+    logger.info("Fetch: %s", url)
+    with http_client.stream(url, deadline=deadline, headers=headers) as res:
+        if res.status_code == 304 and cached is not None:
+            summary_cache.counter["revalidated"] += 1
+            summary_cache.set(key, {**cached, "fetched_at": time.time()})
+            return cached["summary"]
+
+        # 拡張子が .pdf でないバイナリなどは本文を読む前に弾く
+        if not extractor.is_html(res.headers.get("Content-Type")):
+            logger.info("Skip non-HTML content: %s", url)
+            return ""
+
+        # 抽出は本文を読みながら進め、EXTRACT_TOKEN_LIMIT に達したらそこで読むのをやめる
+        text = extractor.extract_paragraphs(
+            http_client.iter_body(res, deadline=deadline),
+            http_client.get_charset(res),
+            EXTRACT_TOKEN_LIMIT,
+            count_tokens,
+        )
 
-    paragraphs = []
-    for p in soup.find_all("p"):
-        paragraphs.append(p.get_text())
+    # 要約は GIL を長く握るので、抽出したテキストだけを別プロセスに渡す
+    # 短いものは要約しないので、プロセスに渡すまでもない
+    if count_tokens(text) < SUMMARY_TOKEN_LIMIT:
+        summary = text
+    else:
+        summary = cpu_pool.run(summarize_text, text, sentences_count, deadline=deadline)
+    if res.status_code == 200:
+        summary_cache.set(
+            key,
+            {
+                "summary": summary,
+                "etag": res.headers.get("ETag"),
+                "last_modified": res.headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+            },
+        )
+    return summary
 
-    paragraphs = list(filter(None, paragraphs))
-    text = "\n".join(paragraphs)
 
-    if len(encoding.encode(text)) < 1024 * 4:
+def preload():
+    get_encoding()
+    if SUMMARIZER == "numpy":
+        from functions import summarizer  # noqa: F401
+    elif SUMMARIZER == "lexrank":
+        from sumy.nlp.tokenizers import Tokenizer
+        from sumy.summarizers.lex_rank import LexRankSummarizer  # noqa: F401
+
+        Tokenizer("japanese")
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text))
+
+
+def summarize_html(html: str, sentences_count: int = 100) -> str:
+    return summarize_text(extract_text(html), sentences_count)
+
+
+def extract_text(html: str) -> str:
+    from functions import extractor
+
+    return extractor.extract_paragraphs(
+        [html.encode("utf-8")], "utf-8", EXTRACT_TOKEN_LIMIT, count_tokens
+    )
+
+
+def summarize_text(
+    text: str, sentences_count: int = 100, summarizer_name: str = SUMMARIZER
+) -> str:
+    if count_tokens(text) < SUMMARY_TOKEN_LIMIT:
         return text
 
+    if summarizer_name == "numpy":
+        # numpy は読み込みが重く、要約は cpu_pool のプロセスで動くので、ここで読む
+        from functions import summarizer
+
+        return summarizer.summarize(
+            text, sentences_count, SUMMARY_TOKEN_LIMIT, count_tokens
+        )
+
+    # sumy (と nltk) は読み込みが重いので、使うときだけ読む
+    from sumy.nlp.tokenizers import Tokenizer
+    from sumy.parsers.plaintext import PlaintextParser
+    from sumy.summarizers.lex_rank import LexRankSummarizer
+
     parser = PlaintextParser.from_string(text, Tokenizer("japanese"))
-    summarizer = LexRankSummarizer()
+    lex_rank_summarizer = LexRankSummarizer()
 
-    res = summarizer(document=parser.document, sentences_count=sentences_count)
+    res = lex_rank_summarizer(document=parser.document, sentences_count=sentences_count)
     res = "".join([s.__str__() for s in res])
     return res
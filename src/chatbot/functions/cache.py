@@ -0,0 +1,126 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Optional
+
+# 設定すると SQLite に保存してコンテナの再起動をまたいでキャッシュを使い回す
+TOOL_CACHE_PATH = os.environ.get("TOOL_CACHE_PATH")
+
+caches: dict = {}
+
+
+class MemoryCache:
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.counter: Counter = Counter()
+        self.entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.counter["misses"] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.counter["hits"] += 1
+            return entry[1]
+
+    def set(self, key: str, value: Any):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.counter["evictions"] += 1
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SQLiteCache:
+    def __init__(self, name: str, maxsize: int, ttl: float, path: str):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.counter: Counter = Counter()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache (name TEXT, key TEXT, value TEXT, "
+            "expires_at REAL, accessed_at REAL, PRIMARY KEY (name, key))"
+        )
+        self.db.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM cache WHERE name = ? AND key = ? AND expires_at > ?",
+                (self.name, key, now),
+            ).fetchone()
+
+            if row is None:
+                self.counter["misses"] += 1
+                return None
+
+            self.db.execute(
+                "UPDATE cache SET accessed_at = ? WHERE name = ? AND key = ?",
+                (now, self.name, key),
+            )
+            self.db.commit()
+            self.counter["hits"] += 1
+            return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (self.name, key, json.dumps(value), now + self.ttl, now),
+            )
+            self.db.execute(
+                "DELETE FROM cache WHERE name = ? AND expires_at <= ?",
+                (self.name, now),
+            )
+            deleted = self.db.execute(
+                "DELETE FROM cache WHERE name = ? AND key IN (SELECT key FROM cache "
+                "WHERE name = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.name, self.name, self.maxsize),
+            ).rowcount
+            self.db.commit()
+            if deleted:
+                self.counter["evictions"] += deleted
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute(
+                "SELECT COUNT(*) FROM cache WHERE name = ?", (self.name,)
+            ).fetchone()[0]
+
+
+def make_cache(name: str, maxsize: int, ttl: float):
+    if TOOL_CACHE_PATH:
+        cache = SQLiteCache(name, maxsize, ttl, TOOL_CACHE_PATH)
+    else:
+        cache = MemoryCache(name, maxsize, ttl)
+    caches[name] = cache
+    return cache
+
+
+def make_key(*args) -> str:
+    return json.dumps(args, ensure_ascii=False)
+
+
+def stats() -> dict:
+    return {name: dict(cache.counter) for name, cache in caches.items()}
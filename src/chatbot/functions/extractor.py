@@ -0,0 +1,48 @@
+from collections.abc import Iterable
+from typing import Callable, Optional
+
+from lxml import etree
+
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+
+
+def is_html(content_type: Optional[str]) -> bool:
+    # Content-Type が無いときは HTML とみなして読んでみる
+    if not content_type:
+        return True
+    return content_type.split(";")[0].strip().lower() in HTML_CONTENT_TYPES
+
+
+def extract_paragraphs(
+    chunks: Iterable[bytes],
+    charset: Optional[str] = None,
+    token_limit: Optional[int] = None,
+    count_tokens: Optional[Callable[[str], int]] = None,
+) -> str:
+    # 本文を読みながら lxml でパースし、<p> が閉じるたびにテキストを取り出す
+    # token_limit 分のテキストが集まったら残りは読まずに打ち切る
+    parser = etree.HTMLPullParser(events=("end",), tag="p", encoding=charset)
+    paragraphs = []
+    num_tokens = 0
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            text = "".join(element.itertext())
+            # 読み終わった <p> は消してツリーが大きくならないようにする
+            element.clear(keep_tail=True)
+            if not text:
+                continue
+
+            paragraphs.append(text)
+            if token_limit is not None and count_tokens is not None:
+                num_tokens += count_tokens(text)
+                if num_tokens >= token_limit:
+                    return "\n".join(paragraphs)
+
+    parser.close()
+    for _, element in parser.read_events():
+        text = "".join(element.itertext())
+        if text:
+            paragraphs.append(text)
+    return "\n".join(paragraphs)
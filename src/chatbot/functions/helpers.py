@@ -1,14 +1,26 @@
+import os
+import unicodedata
 from datetime import datetime
+from functools import lru_cache
+from typing import Optional
 
-import boto3
 import pytz
-from geopy import distance
+from functions import cache
 
+GEOCODE_CACHE_TTL = 60 * 60 * 24 * 30
+# 負荷試験などでローカルのスタブに向けるときだけ設定する
+LOCATION_ENDPOINT_URL = os.environ.get("LOCATION_ENDPOINT_URL")
 
-def get_current_time():
+geocode_cache = cache.make_cache("geocode", maxsize=2048, ttl=GEOCODE_CACHE_TTL)
+
+
+def get_current_time(with_seconds: bool = True):
     jst = pytz.timezone("Asia/Tokyo")
     now = datetime.now(jst)
-    date_time_str = now.strftime("%Y年%m月%d日 %H:%M:%S")
+    if with_seconds:
+        date_time_str = now.strftime("%Y年%m月%d日 %H:%M:%S")
+    else:
+        date_time_str = now.strftime("%Y年%m月%d日 %H:%M")
     weekday_dict = {
         "Monday": "月曜日",
         "Tuesday": "火曜日",
@@ -23,27 +35,56 @@ def get_current_time():
     return f"{date_time_str} {weekday_str}"
 
 
-def get_closest_point(reference_lng_lat: list, results: list) -> list:
+def get_closest_point(reference_lat_lng: list, results: list) -> Optional[list]:
     # Amazon Location Service のレスポンスは同名の地名を複数返すことがある
-    # 都内が正解なことが多いので一番新宿に近い [lng, lat] を返す
-    closest_point = None
-    closest_distance = None
+    # 都内が正解なことが多いので一番新宿に近い [lat, lng] を返す
+    if not results:
+        return None
+
+    # numpy は読み込みが重いので、初めて住所を引くときに読む
+    import numpy as np
+
+    points = np.radians(
+        [result["Place"]["Geometry"]["Point"][::-1] for result in results]
+    )
+    lat, lng = np.radians(reference_lat_lng)
+
+    # haversine の距離は角度について単調なので、比較には中間値 a だけを使う
+    a = (
+        np.sin((points[:, 0] - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(points[:, 0]) * np.sin((points[:, 1] - lng) / 2) ** 2
+    )
+    closest = int(np.argmin(a))
+    return results[closest]["Place"]["Geometry"]["Point"][::-1]
+
+
+@lru_cache(maxsize=None)
+def get_location_client():
+    # boto3 は読み込みが重いので、初めて住所を引くときに読む
+    import boto3
+    from botocore.config import Config
 
-    for result in results:
-        point_lng_lat = result["Place"]["Geometry"]["Point"][::-1]
-        dist = distance.distance(reference_lng_lat, point_lng_lat).km
+    if LOCATION_ENDPOINT_URL:
+        # places. のホスト名プレフィックスが付くと localhost に届かない
+        return boto3.client(
+            "location",
+            endpoint_url=LOCATION_ENDPOINT_URL,
+            config=Config(inject_host_prefix=False),
+        )
+    return boto3.client("location")
 
-        if closest_distance is None or dist < closest_distance:
-            closest_distance = dist
-            closest_point = point_lng_lat
 
-    return closest_point
+def normalize_address(address: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", address).lower().split())
 
 
-def search_lat_lng(address: str):
-    client = boto3.client("location")
+def search_lat_lng(address: str) -> Optional[list]:
+    key = normalize_address(address)
+    point = geocode_cache.get(key)
+    if point is not None:
+        return point
 
-    response = client.search_place_index_for_text(
+    response = get_location_client().search_place_index_for_text(
         FilterCountries=[
             "JPN",
         ],
@@ -52,6 +93,8 @@ def search_lat_lng(address: str):
         Text=address,
     )
 
-    reference_lng_lat = [35.6905, 139.6995]  # 新宿駅の座標
-    point = get_closest_point(reference_lng_lat, response["Results"])
+    reference_lat_lng = [35.6905, 139.6995]  # 新宿駅の座標
+    point = get_closest_point(reference_lat_lng, response["Results"])
+    if point is not None:
+        geocode_cache.set(key, point)
     return point
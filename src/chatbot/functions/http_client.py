@@ -0,0 +1,105 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+REQUEST_TIMEOUT = 5
+MAX_BODY_BYTES = 1024 * 1024 * 2
+MAX_CONNECTIONS_PER_HOST = 2
+POOL_SIZE = 16
+CHUNK_SIZE = 1024 * 64
+
+logger = logging.getLogger(__name__)
+
+session = requests.Session()
+session.mount(
+    "http://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+)
+session.mount(
+    "https://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+)
+
+# 同時接続数を数えておくホストの数。検索結果のホストは毎回変わるので古いものから忘れる
+MAX_TRACKED_HOSTS = 256
+_host_semaphores: OrderedDict[str, threading.BoundedSemaphore] = OrderedDict()
+_host_semaphores_lock = threading.Lock()
+
+
+def _host_semaphore(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).hostname or ""
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(
+                MAX_CONNECTIONS_PER_HOST
+            )
+            if len(_host_semaphores) > MAX_TRACKED_HOSTS:
+                _host_semaphores.popitem(last=False)
+        _host_semaphores.move_to_end(host)
+        return _host_semaphores[host]
+
+
+@contextmanager
+def stream(
+    url: str,
+    timeout: float = REQUEST_TIMEOUT,
+    deadline: Optional[float] = None,
+    **kwargs,
+) -> Iterator[requests.Response]:
+    # 同じホストに同時に投げすぎないよう、ホストごとに同時接続数を絞る
+    semaphore = _host_semaphore(url)
+    if deadline is None:
+        semaphore.acquire()
+    elif not semaphore.acquire(timeout=max(deadline - time.monotonic(), 0)):
+        raise TimeoutError(f"Deadline exceeded while waiting for host: {url}")
+
+    try:
+        res = session.get(url, timeout=timeout, stream=True, **kwargs)
+        try:
+            yield res
+        finally:
+            res.close()
+    finally:
+        semaphore.release()
+
+
+def iter_body(
+    res: requests.Response,
+    max_bytes: int = MAX_BODY_BYTES,
+    deadline: Optional[float] = None,
+) -> Iterator[bytes]:
+    size = 0
+    for chunk in res.iter_content(CHUNK_SIZE):
+        if size + len(chunk) >= max_bytes:
+            logger.info("Body truncated at %d bytes: %s", max_bytes, res.url)
+            yield chunk[: max_bytes - size]
+            return
+        size += len(chunk)
+        yield chunk
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f"Deadline exceeded while reading: {res.url}")
+
+
+def get(
+    url: str,
+    timeout: float = REQUEST_TIMEOUT,
+    max_bytes: int = MAX_BODY_BYTES,
+    deadline: Optional[float] = None,
+    **kwargs,
+) -> requests.Response:
+    with stream(url, timeout=timeout, deadline=deadline, **kwargs) as res:
+        # 読み込んだ分だけを本文として扱う (res.text などがそのまま使える)
+        res._content = b"".join(iter_body(res, max_bytes, deadline))
+    return res
+
+
+def get_charset(res: requests.Response) -> Optional[str]:
+    # requests は charset の無い text/* を ISO-8859-1 とみなすので、ヘッダーを直接見る
+    match = re.search(r"charset=([\w-]+)", res.headers.get("Content-Type", ""), re.I)
+    return match.group(1) if match else None
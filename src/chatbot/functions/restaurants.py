@@ -2,10 +2,18 @@ import json
 import logging
 import os
 
-import requests
-from functions import helpers
+import logs
+from functions import cache, helpers
+
+HOTPEPPER_API_URL = os.environ.get(
+    "HOTPEPPER_API_URL", "https://webservice.recruit.co.jp/hotpepper/gourmet/v1/"
+)
+RESTAURANT_CACHE_TTL = 60 * 10
+# 小数点以下 3 桁で約 100m
+LAT_LNG_DIGITS = 3
 
 logger = logging.getLogger(__name__)
+restaurant_cache = cache.make_cache("restaurant", maxsize=256, ttl=RESTAURANT_CACHE_TTL)
 
 
 def optimize_response(response: dict) -> list:
@@ -31,6 +39,10 @@ def optimize_response(response: dict) -> list:
 def search_restaurants(keyword: str, address: str, is_point: bool) -> str:
     if is_point:
         lat, lng = helpers.search_lat_lng(address)
+        # 近くの地点は同じ検索結果になるので丸めた座標でキャッシュする
+        key = cache.make_key(
+            keyword, round(lat, LAT_LNG_DIGITS), round(lng, LAT_LNG_DIGITS), 5
+        )
         query = {
             "key": os.environ["RECRUIT_API_KEY"],
             "keyword": keyword,
@@ -41,6 +53,7 @@ def search_restaurants(keyword: str, address: str, is_point: bool) -> str:
             "range": 5,
         }
     else:
+        key = cache.make_key(keyword, helpers.normalize_address(address), None)
         query = {
             "key": os.environ["RECRUIT_API_KEY"],
             "keyword": " ".join([keyword, address]),
@@ -48,12 +61,28 @@ def search_restaurants(keyword: str, address: str, is_point: bool) -> str:
             "count": "10",
         }
 
-    logger.info("Restaurant search request: " + json.dumps(query, ensure_ascii=False))
+    shops = restaurant_cache.get(key)
+    if shops is not None:
+        return json.dumps(shops, ensure_ascii=False)
 
-    response = requests.get(
-        "https://webservice.recruit.co.jp/hotpepper/gourmet/v1/", query
+    logger.info(
+        "Restaurant search request: %s",
+        logs.Payload({k: v for k, v in query.items() if k != "key"}),
     )
 
-    logger.info(json.dumps(response.json(), indent=4, ensure_ascii=True))
+    # requests は読み込みが重いので、初めてお店を探すときに読む
+    from functions import http_client
+
+    response = http_client.get(HOTPEPPER_API_URL, params=query)
+    response.raise_for_status()
+    response_json = response.json()
+    results = response_json["results"]
+    logger.info(
+        "Restaurant search response: available=%s returned=%s",
+        results.get("results_available"),
+        results.get("results_returned"),
+    )
 
-    return json.dumps(optimize_response(response.json()), ensure_ascii=False)
+    shops = optimize_response(response_json)
+    restaurant_cache.set(key, shops)
+    return json.dumps(shops, ensure_ascii=False)
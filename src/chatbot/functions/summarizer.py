@@ -0,0 +1,93 @@
+import re
+from typing import Callable
+
+import numpy as np
+
+# グラフを作る前に文の数をこれで打ち切る (類似度行列は文の数の 2 乗で大きくなる)
+MAX_SENTENCES = 400
+MAX_FEATURES = 4096
+SIMILARITY_THRESHOLD = 0.1
+DAMPING = 0.85
+MAX_ITERATIONS = 100
+TOLERANCE = 1e-6
+
+SENTENCE_PATTERN = re.compile(r"[^。！？!?\n]+[。！？!?]*")
+
+
+def split_sentences(text: str) -> list[str]:
+    sentences = [s.strip() for s in SENTENCE_PATTERN.findall(text)]
+    return [s for s in sentences if len(s) > 1]
+
+
+def tfidf_similarity(sentences: list[str]) -> np.ndarray:
+    # 日本語は分かち書きせず文字 bigram を語として扱う
+    vocabulary: dict[str, int] = {}
+    rows = []
+    cols = []
+    for i, sentence in enumerate(sentences):
+        terms = {sentence[j : j + 2] for j in range(len(sentence) - 1)}
+        for term in terms:
+            rows.append(i)
+            cols.append(vocabulary.setdefault(term, len(vocabulary)))
+
+    rows = np.asarray(rows, dtype=np.int32)
+    cols = np.asarray(cols, dtype=np.int32)
+    df = np.bincount(cols, minlength=len(vocabulary))
+    idf = np.log(len(sentences) / df).astype(np.float32) + 1
+    values = idf[cols]
+
+    # ノルムは全語から求めるが、1 文にしか出ない語は文同士の類似度に効かないので
+    # 内積は 2 文以上に出る語 (上位 MAX_FEATURES 語) だけで計算する
+    norms = np.sqrt(np.bincount(rows, weights=values**2, minlength=len(sentences)))
+    shared = np.flatnonzero(df > 1)
+    shared = shared[np.argsort(-df[shared], kind="stable")[:MAX_FEATURES]]
+    column_map = np.full(len(vocabulary), -1, dtype=np.int32)
+    column_map[shared] = np.arange(len(shared), dtype=np.int32)
+
+    mask = column_map[cols] >= 0
+    matrix = np.zeros((len(sentences), len(shared)), dtype=np.float32)
+    matrix[rows[mask], column_map[cols[mask]]] = values[mask]
+
+    similarity = matrix @ matrix.T
+    similarity /= np.outer(norms, norms).clip(min=1e-12)
+    return similarity
+
+
+def lexrank_scores(similarity: np.ndarray) -> np.ndarray:
+    adjacency = (similarity > SIMILARITY_THRESHOLD).astype(np.float32)
+    np.fill_diagonal(adjacency, 1)
+    transition = adjacency / adjacency.sum(axis=1, keepdims=True)
+
+    n = len(similarity)
+    scores = np.full(n, 1 / n, dtype=np.float32)
+    for _ in range(MAX_ITERATIONS):
+        next_scores = (1 - DAMPING) / n + DAMPING * (transition.T @ scores)
+        if np.abs(next_scores - scores).sum() < TOLERANCE:
+            return next_scores
+        scores = next_scores
+    return scores
+
+
+def summarize(
+    text: str,
+    sentences_count: int,
+    token_limit: int,
+    count_tokens: Callable[[str], int],
+) -> str:
+    sentences = split_sentences(text)[:MAX_SENTENCES]
+    if len(sentences) <= 1:
+        return "".join(sentences)
+
+    scores = lexrank_scores(tfidf_similarity(sentences))
+
+    # スコアの高い順に予算いっぱいまで選び、元の順番に並べ直す
+    selected = []
+    num_tokens = 0
+    for i in np.argsort(-scores, kind="stable")[:sentences_count]:
+        sentence_tokens = count_tokens(sentences[i])
+        if num_tokens + sentence_tokens > token_limit:
+            continue
+        selected.append(i)
+        num_tokens += sentence_tokens
+
+    return "".join(sentences[i] for i in sorted(selected))
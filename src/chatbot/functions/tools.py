@@ -0,0 +1,73 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import NamedTuple
+
+import metrics
+from functions import available_functions
+
+TOOL_WORKERS = int(os.environ.get("TOOL_WORKERS", "4"))
+MAX_TOOL_ROUNDS = 3
+DEFAULT_TOOL_TIMEOUT = 20
+# Google 検索はページ取得の締め切り (browser.FETCH_DEADLINE) より長めにとる
+TOOL_TIMEOUTS = {
+    "search_restaurants": 15,
+    "get_current_time": 1,
+    "get_search_results": 30,
+}
+
+logger = logging.getLogger(__name__)
+# ツールは同期 I/O なので、イベントループを塞がないよう専用のスレッドで動かす
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+
+
+class ToolCall(NamedTuple):
+    name: str
+    arguments: str
+
+
+def get_tool_calls(response_message: dict) -> list[ToolCall]:
+    if "function_call" not in response_message:
+        return []
+    function_call = response_message["function_call"]
+    return [ToolCall(function_call["name"], function_call["arguments"])]
+
+
+def error_payload(tool_call: ToolCall, error: str, detail: str) -> str:
+    # モデルにはエラーだと分かる短い JSON だけを返す
+    return json.dumps(
+        {"error": error, "tool": tool_call.name, "detail": detail[:200]},
+        ensure_ascii=False,
+    )
+
+
+async def run_tool(tool_call: ToolCall) -> str:
+    timeout = TOOL_TIMEOUTS.get(tool_call.name, DEFAULT_TOOL_TIMEOUT)
+    try:
+        function_to_call = available_functions[tool_call.name]
+        function_args = json.loads(tool_call.arguments)
+        loop = asyncio.get_running_loop()
+        with metrics.timer("stage.tool." + tool_call.name):
+            return await asyncio.wait_for(
+                loop.run_in_executor(
+                    tool_executor, partial(function_to_call, **function_args)
+                ),
+                timeout=timeout,
+            )
+    except asyncio.TimeoutError:
+        metrics.increment("tool.timeouts")
+        # スレッド自体は止められないが、返事はこれ以上待たない
+        logger.error(f"Tool {tool_call.name} timed out after {timeout} seconds")
+        return error_payload(tool_call, "timeout", f"No result within {timeout}s")
+    except Exception as e:
+        metrics.increment("tool.errors")
+        logger.exception(f"Tool {tool_call.name} failed")
+        return error_payload(tool_call, type(e).__name__, str(e))
+
+
+async def run_tools(tool_calls: list[ToolCall]) -> list[str]:
+    # 互いに依存しない呼び出しは同時に実行する
+    return await asyncio.gather(*[run_tool(tool_call) for tool_call in tool_calls])
@@ -0,0 +1,148 @@
+import atexit
+import logging
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from typing import Callable, NamedTuple, Optional
+
+import discord
+import metrics
+
+MESSAGE_CACHE_SIZE = int(os.environ.get("MESSAGE_CACHE_SIZE", "10000"))
+MESSAGE_CACHE_PATH = os.environ.get("MESSAGE_CACHE_PATH")
+# SQLite 側は挿入 PRUNE_INTERVAL 回ごとに古いメッセージを消して DB_MAX_ROWS 件に保つ
+DB_MAX_ROWS = MESSAGE_CACHE_SIZE * 10
+PRUNE_INTERVAL = 1000
+# コミットは fsync を伴って重いので、COMMIT_INTERVAL 秒か COMMIT_BATCH 件ごとにまとめる
+COMMIT_INTERVAL = 5
+COMMIT_BATCH = 100
+
+logger = logging.getLogger(__name__)
+
+
+class CachedMessage(NamedTuple):
+    role: str
+    content: str
+    parent_id: Optional[int]
+
+
+def clean_message(message: str) -> str:
+    return re.sub(r"<@\d+>", "", message).strip()
+
+
+class MessageCache:
+    def __init__(
+        self,
+        maxsize: int = MESSAGE_CACHE_SIZE,
+        path: Optional[str] = MESSAGE_CACHE_PATH,
+    ):
+        self.maxsize = maxsize
+        self.entries: OrderedDict[int, CachedMessage] = OrderedDict()
+        self.db = None
+        self.inserts = 0
+        self.uncommitted = 0
+        self.last_commit = time.monotonic()
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS messages "
+                "(id INTEGER PRIMARY KEY, role TEXT, content TEXT, parent_id INTEGER)"
+            )
+            self.db.commit()
+            # 終了時にまだコミットしていない分を書き出す
+            atexit.register(self.commit)
+
+    def get(self, message_id: int) -> Optional[CachedMessage]:
+        entry = self.entries.get(message_id)
+        if entry is not None:
+            self.entries.move_to_end(message_id)
+            return entry
+
+        if self.db is not None:
+            row = self.db.execute(
+                "SELECT role, content, parent_id FROM messages WHERE id = ?",
+                (message_id,),
+            ).fetchone()
+            if row is not None:
+                entry = CachedMessage(*row)
+                self._put(message_id, entry)
+                return entry
+
+        return None
+
+    def put(self, message_id: int, entry: CachedMessage):
+        self._put(message_id, entry)
+
+        if self.db is not None:
+            self.db.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                (message_id, *entry),
+            )
+            self.inserts += 1
+            if self.inserts % PRUNE_INTERVAL == 0:
+                # Discord の ID は snowflake なので ID の小さい順に古い
+                self.db.execute(
+                    "DELETE FROM messages WHERE id < "
+                    "(SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (DB_MAX_ROWS,),
+                )
+            self.uncommitted += 1
+            if (
+                self.uncommitted >= COMMIT_BATCH
+                or time.monotonic() - self.last_commit >= COMMIT_INTERVAL
+            ):
+                self.commit()
+
+    def commit(self):
+        if self.db is not None and self.uncommitted:
+            self.db.commit()
+            self.uncommitted = 0
+            self.last_commit = time.monotonic()
+
+    def _put(self, message_id: int, entry: CachedMessage):
+        self.entries[message_id] = entry
+        self.entries.move_to_end(message_id)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def remember(
+        self, message: discord.Message, get_role: Callable[..., str]
+    ) -> CachedMessage:
+        parent_id = message.reference.message_id if message.reference else None
+        entry = CachedMessage(
+            get_role(message.author), clean_message(message.content), parent_id
+        )
+        self.put(message.id, entry)
+
+        # 返信先がゲートウェイから解決済みで届いていればそれも覚えておく
+        if message.reference and isinstance(
+            message.reference.resolved, discord.Message
+        ):
+            self.remember(message.reference.resolved, get_role)
+
+        return entry
+
+    async def walk_reply_chain(
+        self, message: discord.Message, get_role: Callable[..., str]
+    ) -> AsyncIterator[tuple[int, CachedMessage]]:
+        # 返信先を新しい方から順にたどる。キャッシュに無いものだけ Discord から取る
+        parent_id = message.reference.message_id if message.reference else None
+
+        while parent_id is not None:
+            entry = self.get(parent_id)
+            if entry is None:
+                metrics.increment("message_cache.misses")
+                logger.debug("Message cache miss: %s", parent_id)
+                try:
+                    parent = await message.channel.fetch_message(parent_id)
+                except discord.NotFound:
+                    return
+                entry = self.remember(parent, get_role)
+            else:
+                metrics.increment("message_cache.hits")
+
+            yield parent_id, entry
+            parent_id = entry.parent_id
@@ -0,0 +1,275 @@
+import asyncio
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, NamedTuple, Optional
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# INFO で出すペイロードはこの文字数で切る。0 なら切らない
+LOG_PAYLOAD_LIMIT = int(os.environ.get("LOG_PAYLOAD_LIMIT", "2000"))
+# INFO でも OpenAI とのやりとりを出すリクエストの割合
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0"))
+# /logs 用に手元に残しておく直近のログの件数と、1 行あたりの最大文字数
+LOG_BUFFER_SIZE = int(os.environ.get("LOG_BUFFER_SIZE", "2000"))
+LOG_BUFFER_LINE_LIMIT = 1000
+LOGS_REGION = "us-west-2"
+# CloudWatch は新しい方から、この幅で区切った時間帯ごとに遡って探す
+CLOUDWATCH_FIRST_WINDOW = 60 * 5
+CLOUDWATCH_MIN_WINDOW = 1
+# 1 つの時間帯で読むページ数と、1 回の検索で呼ぶ API の回数の上限
+CLOUDWATCH_MAX_PAGES = 5
+CLOUDWATCH_MAX_REQUESTS = 30
+# 中身を見せずに伏せるログ。/logs では検索にも使わない
+MASKED_MESSAGES = ("OpenAI input messages", "OpenAI response", "input messages")
+JST = timezone(timedelta(hours=9))
+LEVEL_NAMES = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+listener: Optional[QueueListener] = None
+
+
+class Payload:
+    # 実際にログを出すときだけ JSON にする。呼び出し側では組み立てない
+    def __init__(self, value: Any, limit: int = LOG_PAYLOAD_LIMIT):
+        # JSON にするのはログのスレッドなので、その後で書き換えられても困らないよう写しておく
+        self.value = copy.copy(value)
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = json.dumps(self.value, ensure_ascii=False, default=str)
+        if self.limit and len(text) > self.limit:
+            return text[: self.limit] + f"...(+{len(text) - self.limit} chars)"
+        return text
+
+
+def payload_level(logger: logging.Logger) -> Optional[int]:
+    # 全文は DEBUG のときだけ。INFO ではサンプリングしたリクエストだけ切り詰めて出す
+    if logger.isEnabledFor(logging.DEBUG):
+        return logging.DEBUG
+    if random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        return logging.INFO
+    return None
+
+
+def log_payload(logger: logging.Logger, level: Optional[int], msg: str, value: Any):
+    if level is None:
+        return
+    limit = 0 if level == logging.DEBUG else LOG_PAYLOAD_LIMIT
+    logger.log(level, msg, Payload(value, limit))
+
+
+class LogEntry(NamedTuple):
+    created: float
+    levelno: int
+    line: str
+
+
+def mask_line(line: str) -> str:
+    # キーワード検索で中身を当てられないよう、探す前に伏せておく
+    for masked in MASKED_MESSAGES:
+        if masked in line:
+            return line[: line.index(masked) + len(masked)] + ": (...)"
+    return line
+
+
+class RingBufferHandler(logging.Handler):
+    # 直近のログを残しておき、/logs で CloudWatch を見に行かずに返せるようにする
+    def __init__(self, capacity: int = LOG_BUFFER_SIZE):
+        super().__init__()
+        self.entries: deque[LogEntry] = deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            line = mask_line(self.format(record))[:LOG_BUFFER_LINE_LIMIT]
+            self.entries.append(LogEntry(record.created, record.levelno, line))
+        except Exception:
+            self.handleError(record)
+
+    def search(
+        self, n: int, level: int = logging.NOTSET, keyword: Optional[str] = None
+    ) -> list[LogEntry]:
+        # 書き込みは QueueListener のスレッドから来るので、コピーしてから見る
+        matched = []
+        for entry in reversed(list(self.entries)):
+            if entry.levelno >= level and (not keyword or keyword in entry.line):
+                matched.append(entry)
+                if len(matched) >= n:
+                    break
+        matched.reverse()
+        return matched
+
+
+class DeferredQueueHandler(QueueHandler):
+    # 標準の QueueHandler は積む前に format するので、Payload の JSON 化が呼び出し元で走る
+    # レコードはそのまま積み、文字列にするのは QueueListener のスレッドに任せる
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class MessageQueueListener(QueueListener):
+    # 出力先が 2 つあるので、メッセージの組み立て (Payload の JSON 化) は 1 回で済ませる
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+ring_buffer = RingBufferHandler()
+
+
+def setup_logging(level: str = LOG_LEVEL, handler: Optional[logging.Handler] = None):
+    # 書き込みは別スレッドに任せて、イベントループではキューに積むだけにする
+    global listener
+    if listener is not None:
+        listener.stop()
+
+    if handler is None:
+        handler = logging.StreamHandler()
+    formatter = logging.Formatter(logging.BASIC_FORMAT)
+    handler.setFormatter(formatter)
+    ring_buffer.setFormatter(formatter)
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = MessageQueueListener(
+        log_queue, handler, ring_buffer, respect_handler_level=True
+    )
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+    # openai は API を呼ぶたびに INFO を出すので、リクエストごとの記録に任せる
+    if root.level > logging.DEBUG:
+        logging.getLogger("openai").setLevel(logging.WARNING)
+    listener.start()
+
+
+def setup_worker_logging(level: str = LOG_LEVEL):
+    # cpu_pool のプロセスはログが少ないので、QueueListener を挟まず標準エラーに直接書く
+    logging.basicConfig(level=level, format=logging.BASIC_FORMAT, force=True)
+
+
+@atexit.register
+def stop_logging():
+    if listener is not None:
+        listener.stop()
+
+
+@lru_cache(maxsize=None)
+def get_logs_client():
+    import boto3
+
+    return boto3.client("logs", region_name=LOGS_REGION)
+
+
+def parse_level(line: str) -> int:
+    # "INFO:__main__:..." の形式。トレースバックの続きの行などはレベルが分からない
+    level = logging.getLevelName(line.split(":", 1)[0])
+    return level if isinstance(level, int) else logging.NOTSET
+
+
+def filter_pattern(level: int, keyword: Optional[str]) -> str:
+    # CloudWatch のパターンは AND と OR を混ぜられないので、
+    # キーワードがあるときはキーワードで絞り、レベルは手元で絞る
+    if keyword:
+        return json.dumps(keyword, ensure_ascii=False)
+    if level > logging.NOTSET:
+        names = [name for name in LEVEL_NAMES if logging.getLevelName(name) >= level]
+        return " ".join(f'?"{name}:"' for name in names)
+    return ""
+
+
+def search_cloudwatch(
+    log_group: str,
+    n: int,
+    level: int = logging.NOTSET,
+    keyword: Optional[str] = None,
+    hours: float = 1,
+) -> list[LogEntry]:
+    # filter_log_events は古い方から返すので、新しい時間帯から順に区切って遡る
+    pattern = filter_pattern(level, keyword)
+    now = time.time()
+    earliest = now - hours * 60 * 60
+    end = now
+    window = CLOUDWATCH_FIRST_WINDOW
+    requests_left = CLOUDWATCH_MAX_REQUESTS
+    entries: list[LogEntry] = []
+
+    while len(entries) < n and end > earliest and requests_left > 0:
+        start = max(earliest, end - window)
+        request = {
+            "logGroupName": log_group,
+            "startTime": int(start * 1000),
+            "endTime": int(end * 1000),
+            "filterPattern": pattern,
+        }
+        found: deque[LogEntry] = deque(maxlen=n)
+        complete = False
+        for _ in range(min(CLOUDWATCH_MAX_PAGES, requests_left)):
+            requests_left -= 1
+            response = get_logs_client().filter_log_events(**request)
+            for event in response["events"]:
+                line = event["message"].rstrip("\n")
+                levelno = parse_level(line)
+                # EMF のメトリクスの行は飛ばす
+                if levelno < level or line.startswith('{"'):
+                    continue
+                # CloudWatch は伏せる前の行で絞り込むので、伏せた行で確かめ直す
+                line = mask_line(line)
+                if keyword and keyword not in line:
+                    continue
+                found.append(LogEntry(event["timestamp"] / 1000, levelno, line))
+            if "nextToken" not in response:
+                complete = True
+                break
+            request["nextToken"] = response["nextToken"]
+
+        # 読み切れなかった時間帯は新しい側が抜けているので、狭めて読み直す
+        # 絞り込むと中身の無いページが続くことがあり、件数では判断できない
+        if not complete and requests_left > 0 and end - start > CLOUDWATCH_MIN_WINDOW:
+            window = max((end - start) / 4, CLOUDWATCH_MIN_WINDOW)
+            continue
+
+        entries = sorted(found) + entries
+        end = start
+        window *= 4
+
+    return entries[-n:]
+
+
+async def fetch_cloudwatch_logs(
+    log_group: str,
+    n: int,
+    level: int = logging.NOTSET,
+    keyword: Optional[str] = None,
+    hours: float = 1,
+) -> list[LogEntry]:
+    # boto3 は同期 I/O なので、イベントループを塞がないよう別スレッドで呼ぶ
+    return await asyncio.to_thread(
+        search_cloudwatch, log_group, n, level, keyword, hours
+    )
+
+
+def format_entries(entries: list[LogEntry], limit: int) -> str:
+    # 新しいものから limit 文字に収まるだけ詰め、古い順に並べて返す
+    lines: list[str] = []
+    size = 0
+    for entry in reversed(entries):
+        timestamp = datetime.fromtimestamp(entry.created, JST)
+        line = f"[{timestamp:%Y-%m-%d %H:%M:%S}] {entry.line}"
+        if size + len(line) + 1 > limit:
+            if not lines:
+                lines.append(line[: limit - 4] + "...")
+            break
+        lines.append(line)
+        size += len(line) + 1
+    lines.reverse()
+    return "\n".join(lines)
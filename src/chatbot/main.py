@@ -1,66 +1,113 @@
-import json
+import asyncio
 import logging
 import os
-import random
-import re
 import time
-from collections.abc import Iterable
-from datetime import datetime, timedelta, timezone
-from typing import Literal, TypedDict
+from collections.abc import Awaitable, Callable
+from typing import Literal, Optional
 
-import boto3
+import cpu_pool
 import discord
+import logs
+import memory_usage
+import metrics
 import openai
-import tiktoken  # type: ignore[import]
-from functions import available_functions, function_info, helpers
-
-ssm_client = boto3.client("ssm")
-ssm_response = ssm_client.get_parameters(
-    Names=[
-        "/sekimiya-ai/discord-token",
-        "/sekimiya-ai/openai-secret",
-        "/sekimiya-ai/recruit-api-key",
-        "/sekimiya-ai/gcp-api-key",
-        "/sekimiya-ai/google-cse-id",
-    ],
-    WithDecryption=True,
+from completion import create_chat_message
+from encoder import get_encoding
+from functions import cache, function_info, tools
+from history import MessageCache, clean_message
+from memory import ConversationMemory
+from reply import (
+    DISCORD_MESSAGE_LIMIT,
+    StreamingReply,
+    modify_text_style,
+    send_reply,
+)
+from scheduler import BusyError, Scheduler
+from spoilers import SpoilerIndex
+from tokens import (
+    get_system_message,
+    num_tokens_from_message,
+    num_tokens_from_text,
+    trim_messages,
 )
 
-parameters = {param["Name"]: param["Value"] for param in ssm_response["Parameters"]}
-
-DISCORD_TOKEN = parameters["/sekimiya-ai/discord-token"]
-OPENAI_API_KEY = parameters["/sekimiya-ai/openai-secret"]
-os.environ["RECRUIT_API_KEY"] = parameters["/sekimiya-ai/recruit-api-key"]
-os.environ["GCP_API_KEY"] = parameters["/sekimiya-ai/gcp-api-key"]
-os.environ["GOOGLE_CSE_KEY"] = parameters["/sekimiya-ai/google-cse-id"]
-
+PARAMETER_NAMES = [
+    "/sekimiya-ai/discord-token",
+    "/sekimiya-ai/openai-secret",
+    "/sekimiya-ai/recruit-api-key",
+    "/sekimiya-ai/gcp-api-key",
+    "/sekimiya-ai/google-cse-id",
+]
 CHARACTER_SETTING = os.environ["CHARACTER_SETTING"].strip()
-SPOILER_CATEGORY_NAME = "SPOILERS"
 LOG_GROUP_NAME = os.environ["LOG_GROUP_NAME"]
-TOKENS_PER_MESSAGE = 4
-TOKENS_PER_NAME = -1
 SMALL_MODEL_NAME = "gpt-3.5-turbo-0613"
 SMALL_MODEL_TOKEN_LIMIT = 1024 * 4 * 0.9
 LARGE_MODEL_NAME = "gpt-3.5-turbo-16k"
 LARGE_TOKEN_LIMIT = 1024 * 16 * 0.9
-
-logging.basicConfig(level=logging.INFO)
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "true").lower() == "true"
+LOGS_MAX_LINES = 50
+# 512 MiB のタスク向けに、使わないゲートウェイのイベントと discord.py のキャッシュを切る
+MEMORY_BUDGET_MODE = os.environ.get("MEMORY_BUDGET_MODE", "false").lower() == "true"
+BUSY_MESSAGE = "今ちょっと混み合ってます…少し待ってからもう一回話しかけてください！"
+ERROR_MESSAGE = "ごめんなさい、うまく返事ができませんでした…もう一回話しかけてください！"
+
+logs.setup_logging()
 logger = logging.getLogger(__name__)
-openai.api_key = OPENAI_API_KEY
-discord_intents = discord.Intents.default()
-discord_intents.typing = False
-discord_client = discord.Client(intents=discord_intents)
+if MEMORY_BUDGET_MODE:
+    # on_message と、ネタバレ部屋のためのギルドとチャンネルの情報だけ受け取る
+    # メッセージは MessageCache で覚えているので、discord.py 側には持たせない
+    discord_intents = discord.Intents(guilds=True, messages=True)
+    discord_client = discord.Client(
+        intents=discord_intents,
+        max_messages=None,
+        member_cache_flags=discord.MemberCacheFlags.none(),
+        chunk_guilds_at_startup=False,
+    )
+else:
+    discord_intents = discord.Intents.default()
+    discord_intents.typing = False
+    discord_client = discord.Client(intents=discord_intents)
 discord_tree = discord.app_commands.CommandTree(discord_client)
-encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+message_cache = MessageCache()
+scheduler = Scheduler()
+conversation_memory = ConversationMemory(message_cache, scheduler, SMALL_MODEL_NAME)
+spoiler_index = SpoilerIndex()
+background_tasks: set[asyncio.Task] = set()
+
+
+def load_parameters() -> str:
+    # import しただけでは SSM を呼ばない。起動するときに 1 回だけ読んで Discord のトークンを返す
+    # boto3 は読み込みが重いので、起動時に SSM を読むときに初めて読む
+    # 既定のセッションだと読み込んだ API の定義 (10 MiB ほど) がずっと残るので、使い捨てにする
+    import boto3
+
+    ssm_client = boto3.session.Session().client("ssm")
+    ssm_response = ssm_client.get_parameters(Names=PARAMETER_NAMES, WithDecryption=True)
+    parameters = {param["Name"]: param["Value"] for param in ssm_response["Parameters"]}
+
+    openai.api_key = parameters["/sekimiya-ai/openai-secret"]
+    os.environ["RECRUIT_API_KEY"] = parameters["/sekimiya-ai/recruit-api-key"]
+    os.environ["GCP_API_KEY"] = parameters["/sekimiya-ai/gcp-api-key"]
+    os.environ["GOOGLE_CSE_KEY"] = parameters["/sekimiya-ai/google-cse-id"]
+    return parameters["/sekimiya-ai/discord-token"]
+
 
+def warm_up():
+    get_encoding()
+    # 起動時には読まなかったページ取得用のモジュールも、最初の検索の前に読んでおく
+    from functions import extractor, http_client  # noqa: F401
 
-class MessageCore(TypedDict):
-    role: Literal["system", "user", "assistant"]
-    content: str
+    cpu_pool.start()
 
 
-class Message(MessageCore, total=False):
-    name: str
+@discord_client.event
+async def setup_hook():
+    # トークナイザーは最初のメッセージが来る前に裏で読み込んでおく
+    asyncio.get_running_loop().run_in_executor(None, warm_up)
+    for coro in [metrics.monitor_loop_lag(), metrics.flush_periodically()]:
+        task = asyncio.create_task(coro)
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
 
 
 @discord_client.event
@@ -75,143 +122,126 @@ def get_role(author) -> str:
         return "user"
 
 
-def modify_text_style(text: str) -> str:
-    text = re.sub(r"\[(.*?)\]\((.*?)\)", r" \2 ", text)
-
-    text = text.replace("(笑)", "ｗ").replace("（笑）", "ｗ")
-    text = text.replace("♪", "！")
-
-    # ！とか？を重ねて使ってオタク感を出す
-    exclamation_marks = ["！", "！！"]
-    question_marks = ["？", "？？", "！？"]
-    laugh_marks = ["ｗ", "ｗｗ", "ｗｗｗ"]
-    text = "".join(
-        [
-            random.choice(exclamation_marks)
-            if char == "！"
-            else random.choice(question_marks)
-            if char == "？"
-            else random.choice(laugh_marks)
-            if char == "ｗ"
-            else char
-            for char in text
-        ]
-    )
-
-    text.replace("ｗ。", "ｗ ")
-    return text
-
-
-def num_tokens_from_messages(messages: Iterable[Message]) -> int:
-    num_tokens = 0
-    for message in messages:  # type: Message
-        num_tokens += TOKENS_PER_MESSAGE
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += TOKENS_PER_NAME
-    # every reply is primed with <|start|>assistant<|message|>
-    num_tokens += 3
-    return num_tokens
-
-
-def get_completion(messages: list, max_retry: int = 3) -> str:
-    system_content = CHARACTER_SETTING.replace(
-        "<current_datetime>", helpers.get_current_time()
-    )
-    messages.insert(0, {"role": "system", "content": system_content})
-
-    while num_tokens_from_messages(messages) > SMALL_MODEL_TOKEN_LIMIT:
-        messages.pop(1)
-
-    for i in range(max_retry):
-        try:
-            logger.info(
-                "OpenAI input messages: " + json.dumps(messages, ensure_ascii=False)
+def output_text(response_message: dict) -> str:
+    if response_message.get("function_call"):
+        return response_message["function_call"]["arguments"]
+    return response_message.get("content") or ""
+
+
+async def get_completion(
+    messages: list,
+    on_text: Optional[Callable[[str], Awaitable]] = None,
+    record: Optional[dict] = None,
+) -> str:
+    # record にはリクエストごとのログに載せるトークン数などを書き込む
+    if record is None:
+        record = {}
+    payload_level = logs.payload_level(logger)
+    with metrics.timer("stage.trim"):
+        messages.insert(0, get_system_message(CHARACTER_SETTING))
+        num_tokens = trim_messages(messages, SMALL_MODEL_TOKEN_LIMIT)
+
+    model_name = SMALL_MODEL_NAME
+    try:
+        # ツールを呼ぶたびに結果を足して聞き直す。最後の回はツールなしで答えさせる
+        for tool_round in range(tools.MAX_TOOL_ROUNDS + 1):
+            logs.log_payload(
+                logger, payload_level, "OpenAI input messages: %s", messages
             )
-            response = openai.ChatCompletion.create(
-                model=SMALL_MODEL_NAME, messages=messages, functions=function_info
+            metrics.increment("model." + model_name)
+            metrics.increment("tokens.in", num_tokens)
+            record["model"] = model_name
+            record["rounds"] = tool_round + 1
+            record["tokens_in"] = record.get("tokens_in", 0) + num_tokens
+            with metrics.timer(f"stage.openai.round{tool_round}"):
+                if tool_round < tools.MAX_TOOL_ROUNDS:
+                    response_message = await create_chat_message(
+                        on_text,
+                        model=model_name,
+                        messages=messages,
+                        functions=function_info,
+                    )
+                else:
+                    response_message = await create_chat_message(
+                        on_text, model=model_name, messages=messages
+                    )
+            logs.log_payload(
+                logger, payload_level, "OpenAI response: %s", response_message
+            )
+            output_tokens = num_tokens_from_text(output_text(response_message))
+            metrics.increment("tokens.out", output_tokens)
+            record["tokens_out"] = record.get("tokens_out", 0) + output_tokens
+
+            tool_calls = tools.get_tool_calls(response_message)
+            if not tool_calls:
+                break
+            record.setdefault("tools", []).extend(
+                tool_call.name for tool_call in tool_calls
             )
-            logger.info("OpenAI response: " + json.dumps(response, ensure_ascii=False))
-            response_message = response["choices"][0]["message"]
-
-            if "function_call" in response_message:
-                function_name = response_message["function_call"]["name"]
-                function_to_call = available_functions[function_name]
-                function_args = json.loads(
-                    response_message["function_call"]["arguments"]
-                )
-                function_res = function_to_call(**function_args)
-
-                # messages.append(response_message)
-                messages.append(
-                    {"role": "function", "name": function_name, "content": function_res}
-                )
-
-                model_name = SMALL_MODEL_NAME
-                if num_tokens_from_messages(messages) > SMALL_MODEL_TOKEN_LIMIT:
-                    model_name = LARGE_MODEL_NAME
-                    while num_tokens_from_messages(messages) > LARGE_TOKEN_LIMIT:
-                        messages.pop(1)
-
-                logger.info(
-                    "OpenAI input messages: " + json.dumps(messages, ensure_ascii=False)
-                )
-                response = openai.ChatCompletion.create(
-                    model=model_name, messages=messages
-                )
-                logger.info(
-                    "OpenAI response: " + json.dumps(response, ensure_ascii=False)
-                )
-                response_message = response["choices"][0]["message"]
 
-            return response_message["content"]
+            # 自分が何を呼んだかも返さないと、次の回で同じ呼び出しを繰り返してしまう
+            function_call_message = {
+                "role": "assistant",
+                "content": "",
+                "function_call": response_message["function_call"],
+            }
+            messages.append(function_call_message)
+            num_tokens += num_tokens_from_message(function_call_message)
+            for tool_call, function_res in zip(
+                tool_calls, await tools.run_tools(tool_calls)
+            ):
+                function_message = {
+                    "role": "function",
+                    "name": tool_call.name,
+                    "content": function_res,
+                }
+                messages.append(function_message)
+                num_tokens += num_tokens_from_message(function_message)
 
-        except openai.error.OpenAIError as e:
-            logger.error("Error on retry " + str(i) + ": " + str(e))
-            if i < max_retry - 1:
-                logger.info("Retrying after 5 seconds...")
-                time.sleep(5)
-            else:
-                return str(e)
+            if num_tokens > SMALL_MODEL_TOKEN_LIMIT:
+                model_name = LARGE_MODEL_NAME
+                num_tokens = trim_messages(messages, LARGE_TOKEN_LIMIT)
 
+        return response_message["content"]
 
-def clean_message(message: str) -> str:
-    return re.sub(r"<@\d+>", "", message).strip()
+    except openai.error.OpenAIError as e:
+        # 失敗したときは原因を追えるように送った内容を全部残す
+        logger.error(
+            "OpenAI request failed: %s, input messages: %s",
+            e,
+            logs.Payload(messages, limit=0),
+        )
+        metrics.increment("openai.errors")
+        record["error"] = type(e).__name__
+        return str(e)
 
 
 @discord_client.event
 async def on_message(message):
+    message_cache.remember(message, get_role)
+
     if not (
         discord_client.user.mentioned_in(message)
         and message.author != discord_client.user
     ):
         return
 
-    if message.reference:
-        referenced_message = await message.channel.fetch_message(
-            message.reference.message_id
-        )
-        messages = [
-            {
-                "role": get_role(referenced_message.author),
-                "content": clean_message(referenced_message.content),
-            }
-        ]
+    with metrics.timer("stage.on_message"):
+        await respond(message)
 
-        referenced_message = referenced_message.reference
-        while referenced_message is not None:
-            referenced_message = await message.channel.fetch_message(
-                referenced_message.message_id
-            )
-            messages.append(
-                {
-                    "role": get_role(referenced_message.author),
-                    "content": clean_message(referenced_message.content),
-                }
+
+async def respond(message):
+    start = time.perf_counter()
+    record = {
+        "message_id": message.id,
+        "channel_id": message.channel.id,
+        "author_id": message.author.id,
+    }
+    if message.reference:
+        with metrics.timer("stage.reply_chain"):
+            messages = await conversation_memory.build_context(
+                message, get_role, SMALL_MODEL_TOKEN_LIMIT, record=record
             )
-            referenced_message = referenced_message.reference
-        messages.reverse()
         messages.append(
             {
                 "role": get_role(message.author),
@@ -219,97 +249,221 @@ async def on_message(message):
             }
         )
         messages.append({"role": "user", "content": message.content})
-        res = get_completion(messages)
-        await message.channel.send(modify_text_style(res), reference=message)
-
     else:
-        res = get_completion([{"role": "user", "content": message.content}])
-        await message.channel.send(modify_text_style(res), reference=message)
+        messages = [{"role": "user", "content": message.content}]
+    record["history"] = len(messages)
+
+    reply = None
+    if STREAM_REPLIES:
+        reply = StreamingReply(message)
+        with metrics.timer("stage.placeholder"):
+            await reply.start()
+
+    # 同じチャンネルで同じ返信先に同じ内容が送られたら 1 回の生成を共有する
+    key = (
+        message.channel.id,
+        clean_message(message.content),
+        message.reference.message_id if message.reference else None,
+    )
+    try:
+        try:
+            with metrics.timer("stage.completion"):
+                res = await scheduler.run(
+                    message.channel.id,
+                    message.author.id,
+                    key,
+                    lambda: get_completion(
+                        messages, on_text=reply.feed if reply else None, record=record
+                    ),
+                )
+        except BusyError:
+            record["busy"] = True
+            res = BUSY_MESSAGE
+        except Exception as e:
+            # get_completion が拾えなかった失敗でも、途中まで流した返信はエラーで置き換える
+            logger.exception("Failed to get completion")
+            record["error"] = type(e).__name__
+            res = ERROR_MESSAGE
+
+        with metrics.timer("stage.send"):
+            if reply is not None:
+                sent_messages = await reply.finish(res)
+            else:
+                sent_messages = await send_reply(message, modify_text_style(res))
+    finally:
+        if reply is not None:
+            reply.stop()
+
+    for sent_message in sent_messages:
+        message_cache.remember(sent_message, get_role)
+
+    record["latency_ms"] = round((time.perf_counter() - start) * 1000)
+    logger.info("Request: %s", logs.Payload(record))
+
+
+@discord_client.event
+async def on_raw_message_edit(payload):
+    # discord.py のメッセージキャッシュを切っていても届くよう、raw イベントで受ける
+    entry = message_cache.get(payload.message_id)
+    if entry is not None and "content" in payload.data:
+        message_cache.put(
+            payload.message_id,
+            entry._replace(content=clean_message(payload.data["content"])),
+        )
+
+
+@discord_client.event
+async def on_guild_channel_create(channel):
+    spoiler_index.add(channel)
+
+
+@discord_client.event
+async def on_guild_channel_update(before, after):
+    spoiler_index.update(before, after)
+
+
+@discord_client.event
+async def on_guild_channel_delete(channel):
+    spoiler_index.remove(channel)
 
 
 @discord_tree.command(name="list-spoiler-channels", description="ネタバレ部屋の一覧を表示します。")
+@discord.app_commands.guild_only()
 async def list_spoiler_channels(interaction: discord.Interaction):
-    guild = interaction.guild
-    spoiler_category = None
-
-    for category in guild.categories:
-        if category.name.upper() == SPOILER_CATEGORY_NAME:
-            spoiler_category = category
-            break
+    channels = spoiler_index.get_channels(interaction.guild).values()
+    if not channels:
+        await interaction.response.send_message("ネタバレ部屋がありません。", ephemeral=True)
+        return
 
-    channels = spoiler_category.channels
-    channel_list = "\n".join([f"- {channel.name}" for channel in channels])
+    channel_list = "\n".join(
+        [f"- {channel.name}" for channel in sorted(channels, key=lambda c: c.position)]
+    )
     response_message = f"```\n{channel_list}```"
     await interaction.response.send_message(response_message, ephemeral=True)
 
 
 @discord_tree.command(name="join-spoiler-channel", description="ネタバレ部屋に参加します。")
+@discord.app_commands.guild_only()
 async def join_spoiler_channels(interaction: discord.Interaction, channel_name: str):
-    guild = interaction.guild
-    spoiler_category = None
-
-    for category in guild.categories:
-        if category.name.upper() == SPOILER_CATEGORY_NAME:
-            spoiler_category = category
-            break
-
-    target_channel = None
-    for channel in spoiler_category.channels:
-        if channel.name.lower() == channel_name.lower():
-            target_channel = channel
-            break
-
+    target_channel = spoiler_index.get(interaction.guild, channel_name)
     if target_channel is None:
         await interaction.response.send_message("該当のチャンネルが見つかりません。", ephemeral=True)
+        return
 
     member = interaction.user
     overwrites = target_channel.overwrites_for(member)
     overwrites.read_messages = True
     await target_channel.set_permissions(member, overwrite=overwrites)
     await interaction.response.send_message(
-        f"{channel_name} チャンネルに参加しました。", ephemeral=True
+        f"{target_channel.name} チャンネルに参加しました。", ephemeral=True
     )
 
 
-@discord_tree.command(name="logs", description="関宮AIのログを直近n件表示します。")
-async def fetch_bot_logs(interaction: discord.Interaction, n: int = 10):
-    if n > 20:
-        n = 20
+@join_spoiler_channels.autocomplete("channel_name")
+async def spoiler_channel_autocomplete(
+    interaction: discord.Interaction, current: str
+) -> list[discord.app_commands.Choice[str]]:
+    return [
+        discord.app_commands.Choice(name=channel.name, value=channel.name)
+        for channel in spoiler_index.search(interaction.guild, current)
+    ]
 
-    logs_client = boto3.client("logs", region_name="us-west-2")
 
-    log_streams_response = logs_client.describe_log_streams(
-        logGroupName=LOG_GROUP_NAME, orderBy="LastEventTime", descending=True, limit=1
+@discord_tree.command(name="logs", description="関宮AIのログを直近n件表示します。")
+# 時間を遡ってほかの人の会話のログまで探せるので、サーバーの管理者だけに見せる
+@discord.app_commands.guild_only()
+@discord.app_commands.default_permissions(administrator=True)
+async def fetch_bot_logs(
+    interaction: discord.Interaction,
+    n: int = 10,
+    level: Optional[Literal["DEBUG", "INFO", "WARNING", "ERROR"]] = None,
+    keyword: Optional[str] = None,
+    hours: Optional[int] = None,
+):
+    n = min(n, LOGS_MAX_LINES)
+    levelno = logging.getLevelName(level) if level else logging.NOTSET
+    # コードブロックの ``` の分を空けておく
+    limit = DISCORD_MESSAGE_LIMIT - 8
+
+    # ふだんは手元に残っている直近のログから返す
+    if hours is None:
+        entries = logs.ring_buffer.search(n, levelno, keyword)
+        if len(entries) >= n:
+            response_message = logs.format_entries(entries, limit)
+            await interaction.response.send_message(f"```\n{response_message}```")
+            return
+
+    # 足りないときや、時間を遡って見たいときは CloudWatch から探す
+    await interaction.response.defer()
+    entries = await logs.fetch_cloudwatch_logs(
+        LOG_GROUP_NAME, n, levelno, keyword, hours or 1
+    )
+    response_message = logs.format_entries(entries, limit) or "該当するログがありません。"
+    await interaction.followup.send(f"```\n{response_message}```")
+
+
+@discord_tree.command(name="stats", description="関宮AIの処理時間などの統計を表示します。")
+async def show_stats(interaction: discord.Interaction):
+    snapshot = metrics.snapshot()
+    lines = [f"{'name':<32} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8}"]
+    for name, histogram in sorted(snapshot["histograms"].items()):
+        lines.append(
+            f"{name[:32]:<32} {histogram['count']:>6}"
+            + "".join(f" {histogram[p]:>6.0f}ms" for p in ["p50", "p95", "p99"])
+        )
+    lines.append("")
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append(f"{name}: {value}")
+    for name, counter in cache.stats().items():
+        lines.append(f"cache.{name}: {counter}")
+
+    # コードブロックの ``` の分を空けておく
+    response_message = "\n".join(lines)[: DISCORD_MESSAGE_LIMIT - 8]
+    await interaction.response.send_message(
+        f"```\n{response_message}```", ephemeral=True
     )
 
-    log_stream_name = log_streams_response["logStreams"][0]["logStreamName"]
-
-    # Get the latest log events from the log stream
-    end_time = datetime.now(timezone.utc)
-    start_time = end_time - timedelta(hours=1)
-    log_events_response = logs_client.get_log_events(
-        logGroupName=LOG_GROUP_NAME,
-        logStreamName=log_stream_name,
-        startTime=int(start_time.timestamp() * 1000),
-        endTime=int(end_time.timestamp() * 1000),
-        limit=n,
-        startFromHead=False,
+
+@discord_tree.command(name="memory", description="関宮AIのメモリの使用量を表示します。")
+# tracemalloc を動かすとボット全体が遅くなるので、サーバーの管理者だけに見せる
+@discord.app_commands.guild_only()
+@discord.app_commands.default_permissions(administrator=True)
+async def show_memory(
+    interaction: discord.Interaction,
+    n: int = 10,
+    tracemalloc: Optional[Literal["start", "stop"]] = None,
+):
+    # tracemalloc は計測中だけ遅くなるので、必要なときにこのコマンドで切り替える
+    if tracemalloc == "start":
+        memory_usage.start_tracing()
+    elif tracemalloc == "stop":
+        memory_usage.stop_tracing()
+
+    await interaction.response.defer(ephemeral=True)
+    lines = memory_usage.rss_lines()
+    lines.append("")
+    lines.append(f"message_cache: {len(message_cache.entries)}/{message_cache.maxsize}")
+    lines.append(
+        f"conversation_memory: {len(conversation_memory.summaries)}"
+        f"/{conversation_memory.maxsize}"
     )
+    lines.append(f"log_buffer: {len(logs.ring_buffer.entries)}")
+    lines.append(f"discord.messages: {len(discord_client.cached_messages)}")
+    for name, tool_cache in cache.caches.items():
+        lines.append(f"cache.{name}: {len(tool_cache)}/{tool_cache.maxsize}")
+
+    top = await asyncio.to_thread(memory_usage.top_allocations, n)
+    lines.append("")
+    lines.extend(top or ["tracemalloc: off"])
 
-    jst_offset = timedelta(hours=9)
-    messages = []
+    # コードブロックの ``` の分を空けておく
+    response_message = "\n".join(lines)[: DISCORD_MESSAGE_LIMIT - 8]
+    await interaction.followup.send(f"```\n{response_message}```", ephemeral=True)
 
-    for event in log_events_response["events"]:
-        log_message = event["message"]
-        if "OpenAI response" in log_message:
-            log_message = "INFO:__main__:OpenAI response: (...)"
-        utc_timestamp = datetime.fromtimestamp(event["timestamp"] / 1000, timezone.utc)
-        jst_timestamp = str(utc_timestamp + jst_offset).split(".")[0]
-        messages.append(f"[{jst_timestamp}] {log_message}")
 
-    response_message = "\n".join(messages)
-    await interaction.response.send_message(f"```\n{response_message}```")
+def run():
+    discord_client.run(load_parameters())
 
 
 if __name__ == "__main__":
-    discord_client.run(DISCORD_TOKEN)
+    run()
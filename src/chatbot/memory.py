@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import discord
+import metrics
+import openai
+from completion import create_chat_message
+from history import MessageCache
+from scheduler import BusyError, Scheduler
+from tokens import Message, num_tokens_from_message
+
+CONVERSATION_SUMMARY_CACHE_SIZE = int(
+    os.environ.get("CONVERSATION_SUMMARY_CACHE_SIZE", "1000")
+)
+# 直近のこのトークン数ぶんの発言はそのまま送り、それより古いものは要約に回す
+RECENT_TOKEN_LIMIT = int(os.environ.get("RECENT_TOKEN_LIMIT", "1024"))
+# 要約されていない古い発言がこのトークン数を超えたら要約を作り直す
+SUMMARY_BATCH_TOKENS = 512
+SUMMARY_INPUT_TOKEN_LIMIT = 1024 * 3
+SUMMARY_MAX_TOKENS = 400
+SUMMARY_MAX_RETRY = 1
+SUMMARY_PROMPT = (
+    "あなたは会話の記録係です。"
+    "これまでの要約と続きの会話を読み、続きの返答に必要な事実・依頼・決まったことを"
+    "落とさずに、日本語で 300 文字以内の要約にまとめてください。"
+)
+SUMMARY_PREFIX = "これまでの会話の要約: "
+ROLE_NAMES = {"user": "ユーザー", "assistant": "あなた"}
+# スケジューラーの待ち行列で要約を並べるときのユーザー ID の代わり
+SUMMARY_QUEUE = "summary"
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationMemory:
+    # スレッドの古い発言を要約して覚えておき、要約と直近の発言だけを送る
+    # 要約は「その発言までの会話」の要約として、要約に含めた最後の発言の ID で引く
+    # 返信のツリーは途中で枝分かれするので、ルートではなく最後の発言をキーにする
+    def __init__(
+        self,
+        message_cache: MessageCache,
+        scheduler: Scheduler,
+        model: str,
+        maxsize: int = CONVERSATION_SUMMARY_CACHE_SIZE,
+    ):
+        self.message_cache = message_cache
+        self.scheduler = scheduler
+        self.model = model
+        self.maxsize = maxsize
+        self.summaries: OrderedDict[int, str] = OrderedDict()
+        self.pending: set[int] = set()
+        self.tasks: set[asyncio.Task] = set()
+
+    def get(self, message_id: int) -> Optional[str]:
+        summary = self.summaries.get(message_id)
+        if summary is not None:
+            self.summaries.move_to_end(message_id)
+        return summary
+
+    def put(self, message_id: int, summary: str):
+        self.summaries[message_id] = summary
+        self.summaries.move_to_end(message_id)
+        if len(self.summaries) > self.maxsize:
+            self.summaries.popitem(last=False)
+
+    async def build_context(
+        self,
+        message: discord.Message,
+        get_role: Callable[..., str],
+        token_limit: float,
+        record: Optional[dict] = None,
+    ) -> list[Message]:
+        if record is None:
+            record = {}
+
+        # 要約済みの発言に行き当たるか、token_limit を超えるまで遡る
+        turns: list[tuple[int, Message]] = []
+        num_tokens = 0
+        summary = None
+        async for message_id, entry in self.message_cache.walk_reply_chain(
+            message, get_role
+        ):
+            summary = self.get(message_id)
+            if summary is not None:
+                metrics.increment("memory.hits")
+                break
+            turn: Message = {"role": entry.role, "content": entry.content}
+            turns.append((message_id, turn))
+            num_tokens += num_tokens_from_message(turn)
+            if num_tokens > token_limit:
+                break
+        turns.reverse()
+
+        # 新しい方から RECENT_TOKEN_LIMIT に収まるだけを直近の発言とする
+        split = len(turns)
+        recent_tokens = 0
+        while split > 0:
+            recent_tokens += num_tokens_from_message(turns[split - 1][1])
+            if recent_tokens > RECENT_TOKEN_LIMIT and split < len(turns):
+                break
+            split -= 1
+        older = turns[:split]
+
+        older_tokens = sum(num_tokens_from_message(turn) for _, turn in older)
+        if older_tokens > SUMMARY_BATCH_TOKENS:
+            self.schedule_summary(
+                message.channel.id, older[-1][0], summary, [turn for _, turn in older]
+            )
+
+        # 要約がまだできていない古い発言は、今回はそのまま送る
+        messages: list[Message] = []
+        if summary is not None:
+            messages.append({"role": "system", "content": SUMMARY_PREFIX + summary})
+        messages.extend(turn for _, turn in turns)
+        record["summary"] = summary is not None
+        record["unsummarized"] = len(older)
+        return messages
+
+    def schedule_summary(
+        self,
+        channel_id: int,
+        message_id: int,
+        summary: Optional[str],
+        turns: list[Message],
+    ):
+        if message_id in self.pending or message_id in self.summaries:
+            return
+        self.pending.add(message_id)
+        task = asyncio.create_task(
+            self.summarize(channel_id, message_id, summary, turns)
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def summarize(
+        self,
+        channel_id: int,
+        message_id: int,
+        summary: Optional[str],
+        turns: list[Message],
+    ):
+        # 入力が長すぎるときは古い発言から削る
+        num_tokens = sum(num_tokens_from_message(turn) for turn in turns)
+        while num_tokens > SUMMARY_INPUT_TOKEN_LIMIT and len(turns) > 1:
+            num_tokens -= num_tokens_from_message(turns.pop(0))
+
+        lines = []
+        if summary is not None:
+            lines.append("これまでの要約:\n" + summary + "\n")
+        lines.append("続きの会話:")
+        for turn in turns:
+            lines.append(
+                f"{ROLE_NAMES.get(turn['role'], turn['role'])}: {turn['content']}"
+            )
+
+        # 返答と同じスケジューラーに並べ、OpenAI への同時リクエスト数の上限を守る
+        # 要約は要約用の枠で、そのチャンネルのユーザーと順番に取り出される
+        try:
+            with metrics.timer("stage.summary"):
+                response = await self.scheduler.run(
+                    channel_id,
+                    SUMMARY_QUEUE,
+                    (SUMMARY_QUEUE, message_id),
+                    lambda: create_chat_message(
+                        model=self.model,
+                        messages=[
+                            {"role": "system", "content": SUMMARY_PROMPT},
+                            {"role": "user", "content": "\n".join(lines)},
+                        ],
+                        max_tokens=SUMMARY_MAX_TOKENS,
+                        max_retry=SUMMARY_MAX_RETRY,
+                    ),
+                )
+            self.put(message_id, response["content"])
+            metrics.increment("memory.summaries")
+        except BusyError:
+            # 混んでいるときは諦め、次の返答のときに作り直す
+            metrics.increment("memory.summary_skipped")
+        except openai.error.OpenAIError as e:
+            metrics.increment("memory.summary_errors")
+            logger.warning("Failed to summarize conversation: %s", e)
+        finally:
+            self.pending.discard(message_id)
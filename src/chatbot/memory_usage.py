@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+import resource
+import tracemalloc
+from typing import Optional
+
+# tracemalloc が返すパスのうち、ここより前は表示しない
+PATH_MARKERS = ("site-packages/", "chatbot/", "lib/python")
+# PYTHONTRACEMALLOC と同じく、何段のフレームまで記録するか
+TRACEMALLOC_FRAMES = int(os.environ.get("TRACEMALLOC_FRAMES", "1"))
+
+
+def read_status(pid: str = "self") -> dict[str, int]:
+    # Linux の /proc/<pid>/status から VmRSS (現在) と VmHWM (ピーク) を KiB で読む
+    status = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    status[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return status
+
+
+def rss_lines() -> list[str]:
+    status = read_status()
+    # /proc が読めない環境では getrusage のピークだけ出す
+    peak = status.get("VmHWM", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    lines = [
+        f"main: rss={status.get('VmRSS', 0) / 1024:.1f}MiB peak={peak / 1024:.1f}MiB"
+    ]
+    for child in multiprocessing.active_children():
+        child_status = read_status(str(child.pid))
+        lines.append(
+            f"{child.name}: rss={child_status.get('VmRSS', 0) / 1024:.1f}MiB"
+            f" peak={child_status.get('VmHWM', 0) / 1024:.1f}MiB"
+        )
+    return lines
+
+
+def short_path(filename: str) -> str:
+    for marker in PATH_MARKERS:
+        index = filename.rfind(marker)
+        if index >= 0:
+            return filename[index + len(marker) :]
+    return filename
+
+
+def start_tracing(frames: int = TRACEMALLOC_FRAMES):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def stop_tracing():
+    tracemalloc.stop()
+
+
+def top_allocations(n: int = 10) -> Optional[list[str]]:
+    # 計測中でなければ None を返す。スナップショットは重いのでイベントループの外で呼ぶ
+    if not tracemalloc.is_tracing():
+        return None
+
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ]
+    )
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [
+        f"traced: current={current / 1024 / 1024:.1f}MiB peak={peak / 1024 / 1024:.1f}MiB"
+    ]
+    for stat in snapshot.statistics("lineno")[:n]:
+        frame = stat.traceback[0]
+        lines.append(
+            f"{stat.size / 1024:>9.1f}KiB {stat.count:>7} "
+            f"{short_path(frame.filename)}:{frame.lineno}"
+        )
+    return lines
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "SekimiyaAI")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "60"))
+# /stats で出すパーセンタイルは直近この件数から計算する
+METRICS_WINDOW = 1024
+LOOP_LAG_INTERVAL = 1.0
+# EMF で 1 つのメトリクスに載せられる値の種類の上限
+EMF_MAX_VALUES = 100
+
+logger = logging.getLogger(__name__)
+# EMF は 1 行がそのまま JSON になっている必要があるので、プレフィックスを付けずに出す
+emf_logger = logging.getLogger("metrics.emf")
+emf_logger.propagate = False
+emf_handler = logging.StreamHandler(sys.stdout)
+emf_handler.setFormatter(logging.Formatter("%(message)s"))
+emf_logger.addHandler(emf_handler)
+emf_logger.setLevel(logging.INFO)
+
+lock = threading.Lock()
+counters: Counter = Counter()
+# 前回 EMF に書き出した時点の counters
+flushed_counters: Counter = Counter()
+histograms: dict[str, "Histogram"] = {}
+
+
+class Histogram:
+    def __init__(self, unit: str, window: int = METRICS_WINDOW):
+        self.unit = unit
+        self.recent: deque = deque(maxlen=window)
+        # 前回 EMF に書き出してから後の値。有効数字 2 桁に丸めて数える
+        self.pending: Counter = Counter()
+        self.count = 0
+
+    def observe(self, value: float):
+        self.recent.append(value)
+        self.pending[float(f"{value:.2g}")] += 1
+        self.count += 1
+
+    def percentiles(self, ps: tuple = (50, 95, 99)) -> dict:
+        ordered = sorted(self.recent)
+        if not ordered:
+            return {}
+        return {
+            f"p{p}": ordered[min(len(ordered) - 1, len(ordered) * p // 100)] for p in ps
+        }
+
+
+def observe(name: str, value: float, unit: str = "Milliseconds"):
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram(unit)
+        histogram.observe(value)
+
+
+def increment(name: str, value: int = 1):
+    with lock:
+        counters[name] += value
+
+
+@contextmanager
+def timer(name: str):
+    # await をまたいでも使える。かかった時間をミリ秒で記録する
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, (time.perf_counter() - start) * 1000)
+
+
+def snapshot() -> dict:
+    with lock:
+        return {
+            "counters": dict(counters),
+            "histograms": {
+                name: {"count": histogram.count, **histogram.percentiles()}
+                for name, histogram in histograms.items()
+            },
+        }
+
+
+def emf_record() -> dict:
+    # CloudWatch Embedded Metric Format。前回から後に増えた分だけを書き出す
+    with lock:
+        record = {}
+        definitions = []
+        for name, histogram in histograms.items():
+            if not histogram.pending:
+                continue
+            values = histogram.pending.most_common(EMF_MAX_VALUES)
+            record[name] = {
+                "Values": [value for value, _ in values],
+                "Counts": [count for _, count in values],
+            }
+            definitions.append({"Name": name, "Unit": histogram.unit})
+            histogram.pending.clear()
+        for name, value in counters.items():
+            if value > flushed_counters[name]:
+                record[name] = value - flushed_counters[name]
+                definitions.append({"Name": name, "Unit": "Count"})
+        flushed_counters.update(counters - flushed_counters)
+
+    if not definitions:
+        return {}
+    record["Service"] = "sekimiya-ai"
+    record["_aws"] = {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [
+            {
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [["Service"]],
+                "Metrics": definitions,
+            }
+        ],
+    }
+    return record
+
+
+def flush():
+    record = emf_record()
+    if record:
+        emf_logger.info(json.dumps(record, ensure_ascii=False))
+
+
+async def flush_periodically(interval: float = METRICS_FLUSH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            flush()
+        except Exception:
+            logger.exception("Failed to flush metrics")
+
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    # sleep が予定よりどれだけ遅れて戻ってきたかをイベントループの遅延とみなす
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        observe("event_loop.lag", (time.perf_counter() - start - interval) * 1000)
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+import random
+import re
+from typing import Optional
+
+import discord
+
+DISCORD_MESSAGE_LIMIT = 2000
+# メッセージの編集はチャンネルごとに 5 回 / 5 秒程度までなので間隔をあける
+EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5"))
+PLACEHOLDER = "…"
+# 閉じていない "[" をこれ以上の長さ保留していたらリンクではないとみなす
+MAX_PENDING_LENGTH = 300
+
+LINK_PATTERN = re.compile(r"\[(.*?)\]\((.*?)\)")
+LAUGH_PREFIXES = ("(", "(笑", "（", "（笑")
+
+logger = logging.getLogger(__name__)
+
+
+def modify_text_style(text: str) -> str:
+    text = LINK_PATTERN.sub(r" \2 ", text)
+
+    text = text.replace("(笑)", "ｗ").replace("（笑）", "ｗ")
+    text = text.replace("♪", "！")
+
+    # ！とか？を重ねて使ってオタク感を出す
+    exclamation_marks = ["！", "！！"]
+    question_marks = ["？", "？？", "！？"]
+    laugh_marks = ["ｗ", "ｗｗ", "ｗｗｗ"]
+    text = "".join(
+        [
+            random.choice(exclamation_marks)
+            if char == "！"
+            else random.choice(question_marks)
+            if char == "？"
+            else random.choice(laugh_marks)
+            if char == "ｗ"
+            else char
+            for char in text
+        ]
+    )
+
+    text.replace("ｗ。", "ｗ ")
+    return text
+
+
+class IncrementalStyler:
+    # ストリーミング中の差分に modify_text_style をかける
+    # リンクや (笑) がチャンクの境目で切れていることがあるので、
+    # 置換が確定しない末尾は次のチャンクが来るまで保留する
+    def __init__(self):
+        self.pending = ""
+
+    def feed(self, delta: str) -> str:
+        text = self.pending + delta
+        cut = len(text)
+
+        bracket = text.rfind("[")
+        if (
+            bracket != -1
+            and "\n" not in text[bracket:]
+            and len(text) - bracket < MAX_PENDING_LENGTH
+            and not LINK_PATTERN.search(text, bracket)
+        ):
+            cut = bracket
+
+        for prefix in LAUGH_PREFIXES:
+            if text.endswith(prefix):
+                cut = min(cut, len(text) - len(prefix))
+
+        self.pending = text[cut:]
+        return modify_text_style(text[:cut])
+
+    def flush(self) -> str:
+        text = self.pending
+        self.pending = ""
+        return modify_text_style(text)
+
+
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> list[str]:
+    # 先頭 limit 文字だけを見て区切るので、後ろに文字が増えても区切り位置は変わらない
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit) + 1 or limit
+        chunks.append(text[:cut])
+        text = text[cut:]
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+async def send_reply(message: discord.Message, text: str) -> list[discord.Message]:
+    chunks = split_message(text)
+    sent_messages = [await message.channel.send(chunks[0], reference=message)]
+    for chunk in chunks[1:]:
+        sent_messages.append(await message.channel.send(chunk))
+    return sent_messages
+
+
+class StreamingReply:
+    def __init__(self, message: discord.Message, edit_interval: float = EDIT_INTERVAL):
+        self.reference = message
+        self.channel = message.channel
+        self.edit_interval = edit_interval
+        self.styler = IncrementalStyler()
+        self.raw_text = ""
+        self.text = ""
+        self.sent_messages: list[discord.Message] = []
+        self.shown: list[str] = []
+        self.dirty = asyncio.Event()
+        self.edit_task: Optional[asyncio.Task] = None
+        # _sync が途中で止まると送ったメッセージを記録し損ねるので、同時に 1 つだけ動かす
+        self.sync_lock = asyncio.Lock()
+
+    async def start(self):
+        sent_message = await self.channel.send(PLACEHOLDER, reference=self.reference)
+        self.sent_messages.append(sent_message)
+        self.shown.append(PLACEHOLDER)
+        self.edit_task = asyncio.create_task(self._edit_loop())
+
+    async def feed(self, delta: str):
+        self.raw_text += delta
+        self.text += self.styler.feed(delta)
+        self.dirty.set()
+
+    async def finish(self, text: str) -> list[discord.Message]:
+        # 編集中の _sync が終わるのを待ってから編集のループを止める
+        async with self.sync_lock:
+            if self.edit_task is not None:
+                self.edit_task.cancel()
+                try:
+                    await self.edit_task
+                except asyncio.CancelledError:
+                    pass
+
+            self.text += self.styler.flush()
+            # エラーなどでストリーミングされた内容と最終結果が違う場合は最終結果で置き換える
+            if text != self.raw_text:
+                self.text = modify_text_style(text)
+            await self._sync()
+        return self.sent_messages
+
+    def stop(self):
+        # finish まで届かなかったときに、編集のループだけは止めておく
+        if self.edit_task is not None:
+            self.edit_task.cancel()
+
+    async def _edit_loop(self):
+        while True:
+            await self.dirty.wait()
+            self.dirty.clear()
+            try:
+                async with self.sync_lock:
+                    await self._sync()
+            except discord.HTTPException as e:
+                logger.error(e)
+            await asyncio.sleep(self.edit_interval)
+
+    async def _sync(self):
+        # 2000 文字を超えた分は続きのメッセージとして送る
+        chunks = split_message(self.text) or [PLACEHOLDER]
+        for i, chunk in enumerate(chunks):
+            if i >= len(self.sent_messages):
+                self.sent_messages.append(await self.channel.send(chunk))
+                self.shown.append(chunk)
+            elif self.shown[i] != chunk:
+                self.sent_messages[i] = await self.sent_messages[i].edit(content=chunk)
+                self.shown[i] = chunk
+
+        for sent_message in self.sent_messages[len(chunks) :]:
+            await sent_message.delete()
+        del self.sent_messages[len(chunks) :]
+        del self.shown[len(chunks) :]
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter, OrderedDict, deque
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any, NamedTuple
+
+import metrics
+
+MAX_CONCURRENT_COMPLETIONS = int(os.environ.get("MAX_CONCURRENT_COMPLETIONS", "4"))
+MAX_QUEUED_COMPLETIONS = int(os.environ.get("MAX_QUEUED_COMPLETIONS", "20"))
+
+logger = logging.getLogger(__name__)
+
+
+class BusyError(Exception):
+    pass
+
+
+class Job(NamedTuple):
+    key: Hashable
+    func: Callable[[], Awaitable]
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class Scheduler:
+    # OpenAI へのリクエストを全体で max_concurrency 件までに絞る
+    # 待ち行列はチャンネルごと、その中はユーザーごとに分け、順番に 1 件ずつ取り出す
+    # 同じ内容のリクエストが処理中なら新しく投げずに結果を共有する
+    def __init__(
+        self,
+        max_concurrency: int = MAX_CONCURRENT_COMPLETIONS,
+        max_queue: int = MAX_QUEUED_COMPLETIONS,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.running = 0
+        self.queued = 0
+        self.queues: OrderedDict[Hashable, OrderedDict[Hashable, deque]] = OrderedDict()
+        self.in_flight: dict[Hashable, asyncio.Future] = {}
+        self.counter: Counter = Counter()
+        self.tasks: set[asyncio.Task] = set()
+
+    async def run(
+        self,
+        channel_id: Hashable,
+        user_id: Hashable,
+        key: Hashable,
+        func: Callable[[], Awaitable],
+    ) -> Any:
+        if key in self.in_flight:
+            self.count("coalesced")
+            return await asyncio.shield(self.in_flight[key])
+
+        if self.queued >= self.max_queue:
+            self.count("rejected")
+            raise BusyError()
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        channel_queue = self.queues.setdefault(channel_id, OrderedDict())
+        channel_queue.setdefault(user_id, deque()).append(
+            Job(key, func, future, time.perf_counter())
+        )
+        self.queued += 1
+        self.count("submitted")
+        self._dispatch()
+        return await asyncio.shield(future)
+
+    def count(self, name: str):
+        self.counter[name] += 1
+        metrics.increment("scheduler." + name)
+
+    def _next_job(self) -> Job:
+        channel_id, channel_queue = self.queues.popitem(last=False)
+        user_id, user_queue = channel_queue.popitem(last=False)
+        job = user_queue.popleft()
+
+        # 取り出したユーザーとチャンネルは末尾に回す
+        if user_queue:
+            channel_queue[user_id] = user_queue
+        if channel_queue:
+            self.queues[channel_id] = channel_queue
+        self.queued -= 1
+        return job
+
+    def _dispatch(self):
+        while self.running < self.max_concurrency and self.queues:
+            self.running += 1
+            task = asyncio.create_task(self._run(self._next_job()))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, job: Job):
+        metrics.observe(
+            "stage.queue_wait", (time.perf_counter() - job.enqueued_at) * 1000
+        )
+        try:
+            job.future.set_result(await job.func())
+        except Exception as e:
+            logger.exception("Scheduled job failed")
+            job.future.set_exception(e)
+        finally:
+            self.running -= 1
+            del self.in_flight[job.key]
+            self._dispatch()
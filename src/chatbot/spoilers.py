@@ -0,0 +1,94 @@
+import bisect
+from typing import Optional
+
+import discord
+
+SPOILER_CATEGORY_NAME = "SPOILERS"
+# Discord のオートコンプリートで出せる候補の上限
+AUTOCOMPLETE_LIMIT = 25
+
+
+def is_spoiler_category(category: Optional[discord.CategoryChannel]) -> bool:
+    return category is not None and category.name.upper() == SPOILER_CATEGORY_NAME
+
+
+class SpoilerIndex:
+    # ギルドごとにネタバレ部屋を小文字の名前で引けるようにしておく
+    # 最初に使うときにまとめて作り、あとはチャンネルの作成・変更・削除のイベントで更新する
+    def __init__(self):
+        self.channels: dict[int, dict[str, discord.abc.GuildChannel]] = {}
+        # 前方一致で探すための、ソート済みの名前の一覧
+        self.names: dict[int, list[str]] = {}
+
+    def _build(self, guild: discord.Guild) -> dict[str, discord.abc.GuildChannel]:
+        channels = {}
+        for category in guild.categories:
+            if is_spoiler_category(category):
+                for channel in category.channels:
+                    channels[channel.name.lower()] = channel
+        self.channels[guild.id] = channels
+        self.names[guild.id] = sorted(channels)
+        return channels
+
+    def get_channels(self, guild: discord.Guild) -> dict[str, discord.abc.GuildChannel]:
+        channels = self.channels.get(guild.id)
+        if channels is None:
+            channels = self._build(guild)
+        return channels
+
+    def get(
+        self, guild: discord.Guild, name: str
+    ) -> Optional[discord.abc.GuildChannel]:
+        return self.get_channels(guild).get(name.lower())
+
+    def search(
+        self, guild: discord.Guild, prefix: str, limit: int = AUTOCOMPLETE_LIMIT
+    ) -> list[discord.abc.GuildChannel]:
+        channels = self.get_channels(guild)
+        names = self.names[guild.id]
+        prefix = prefix.lower()
+        found = []
+        for name in names[bisect.bisect_left(names, prefix) :]:
+            if not name.startswith(prefix) or len(found) >= limit:
+                break
+            found.append(channels[name])
+        return found
+
+    def add(self, channel: discord.abc.GuildChannel):
+        if isinstance(channel, discord.CategoryChannel):
+            # カテゴリの作成や名前の変更は中のチャンネルごと変わるので作り直す
+            self.invalidate(channel.guild)
+            return
+        if channel.guild.id not in self.channels or not is_spoiler_category(
+            channel.category
+        ):
+            return
+
+        name = channel.name.lower()
+        channels = self.channels[channel.guild.id]
+        if name not in channels:
+            bisect.insort(self.names[channel.guild.id], name)
+        channels[name] = channel
+
+    def remove(self, channel: discord.abc.GuildChannel):
+        if isinstance(channel, discord.CategoryChannel):
+            self.invalidate(channel.guild)
+            return
+        channels = self.channels.get(channel.guild.id)
+        if channels is None:
+            return
+
+        name = channel.name.lower()
+        indexed = channels.get(name)
+        if indexed is not None and indexed.id == channel.id:
+            del channels[name]
+            names = self.names[channel.guild.id]
+            del names[bisect.bisect_left(names, name)]
+
+    def update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        self.remove(before)
+        self.add(after)
+
+    def invalidate(self, guild: discord.Guild):
+        self.channels.pop(guild.id, None)
+        self.names.pop(guild.id, None)
@@ -0,0 +1,106 @@
+import json
+from collections.abc import Iterable
+from functools import lru_cache
+from typing import Literal, TypedDict
+
+from encoder import get_encoding
+from functions import helpers
+
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_NAME = -1
+# every reply is primed with <|start|>assistant<|message|>
+TOKENS_PER_REPLY = 3
+MESSAGE_TOKEN_CACHE_SIZE = 4096
+# 件数だけでは上限にならないので、Discord の 1 メッセージより長いものはキャッシュしない
+MESSAGE_TOKEN_CACHE_MAX_CHARS = 2000
+
+
+class MessageCore(TypedDict):
+    role: Literal["system", "user", "assistant", "function"]
+    content: str
+
+
+class FunctionCall(TypedDict):
+    name: str
+    arguments: str
+
+
+class Message(MessageCore, total=False):
+    name: str
+    function_call: FunctionCall
+
+
+def _count_items(items: tuple) -> int:
+    encoding = get_encoding()
+    num_tokens = TOKENS_PER_MESSAGE
+    for key, value in items:
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += TOKENS_PER_NAME
+    return num_tokens
+
+
+_num_tokens_from_items = lru_cache(maxsize=MESSAGE_TOKEN_CACHE_SIZE)(_count_items)
+
+
+def num_tokens_from_message(message: Message) -> int:
+    # 同じ発言はリプライチェーンを遡るたびに何度も数えられるのでキャッシュしておく
+    # ツールの結果 (検索結果は 8k トークンほど) は 1 回しか数えないので、キャッシュに載せない
+    # function_call は dict のままではキーにできないので、送るときと同じく JSON にして数える
+    items = tuple(
+        (
+            key,
+            json.dumps(value, ensure_ascii=False) if isinstance(value, dict) else value,
+        )
+        for key, value in message.items()
+    )
+    if (
+        message["role"] == "function"
+        or len(message["content"]) > MESSAGE_TOKEN_CACHE_MAX_CHARS
+    ):
+        return _count_items(items)
+    return _num_tokens_from_items(items)
+
+
+def num_tokens_from_text(text: str) -> int:
+    return len(get_encoding().encode(text))
+
+
+def num_tokens_from_messages(messages: Iterable[Message]) -> int:
+    return (
+        sum(num_tokens_from_message(message) for message in messages) + TOKENS_PER_REPLY
+    )
+
+
+def trim_messages(messages: list[Message], token_limit: float) -> int:
+    # 先頭に並んだ system (設定や会話の要約) と最新の発言 (末尾) は残して古い順に削る
+    counts = [num_tokens_from_message(message) for message in messages]
+    num_tokens = sum(counts) + TOKENS_PER_REPLY
+
+    start = 1
+    while start < len(messages) - 1 and messages[start]["role"] == "system":
+        start += 1
+
+    end = start
+    while num_tokens > token_limit and end < len(messages) - 1:
+        num_tokens -= counts[end]
+        end += 1
+
+    del messages[start:end]
+    return num_tokens
+
+
+_system_message_cache: dict = {}
+
+
+def get_system_message(template: str) -> Message:
+    # <current_datetime> は分単位なので、分が変わるまで描画結果とトークン数を使い回す
+    current_time = helpers.get_current_time(with_seconds=False)
+    key = (template, current_time)
+    if key not in _system_message_cache:
+        _system_message_cache.clear()
+        _system_message_cache[key] = {
+            "role": "system",
+            "content": template.replace("<current_datetime>", current_time),
+        }
+    return dict(_system_message_cache[key])
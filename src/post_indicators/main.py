@@ -1,63 +1,150 @@
+import asyncio
+import hashlib
+import json
 import os
 import re
+import time
 from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
 
+import aiohttp
 import boto3
+import lxml.html
 import pytz
 import requests
-from bs4 import BeautifulSoup
 
-ssm_client = boto3.client("ssm")
-ssm_response = ssm_client.get_parameters(
-    Names=["/sekimiya-ai/discord-token"],
-    WithDecryption=True,
-)
+# 配信先の一覧。[{"channel_id": "...", "importance": 3, "countries": ["米国"]}, ...]
+# 無ければ CHANNEL_ID に IMPORTANCE_LEVEL 以上の指標を送る
+SUBSCRIPTIONS = os.environ.get("SUBSCRIPTIONS")
+IMPORTANCE_LEVEL = int(os.environ.get("IMPORTANCE_LEVEL", "3"))
 
+CALENDAR_URL = "https://www.gaikaex.com/gaikaex/mark/calendar/"
+DISCORD_API_BASE = os.environ.get("DISCORD_API_BASE", "https://discord.com/api/v10")
+# (接続, 読み込み) のタイムアウト秒数
+REQUEST_TIMEOUT = (3.05, 10)
+# 同時に投稿するチャンネル数。接続プールの大きさも同じにする
+MAX_CONCURRENT_POSTS = 8
+POST_TIMEOUT = 10
+POST_MAX_RETRY = 3
+RETRY_BASE_DELAY = 1.0
+# retry_after がこれより長ければ、Lambda の時間切れになる前に諦める
+MAX_RETRY_AFTER = 30.0
 
-DISCORD_TOKEN = ssm_response["Parameters"][0]["Value"]
-TARGET_CHANNEL_ID = os.environ["CHANNEL_ID"]
-IMPORTANCE_LEVEL = int(os.environ["IMPORTANCE_LEVEL"])
+JST = pytz.timezone("Asia/Tokyo")
 
-API_ENDPOINT = f"https://discord.com/api/v10/channels/{TARGET_CHANNEL_ID}/messages"
+# Lambda のコンテナが使い回される間は、接続とパース済みのカレンダーを持ち越す
+session = requests.Session()
 
-headers = {
-    "Authorization": f"Bot {DISCORD_TOKEN}",
-    "Content-Type": "application/json",
-}
 
+class CachedCalendar(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    digest: str
+    indicators: List[dict]
 
-def get_indicators():
-    url = "https://www.gaikaex.com/gaikaex/mark/calendar/"
 
-    r = requests.get(url)
+cached_calendar: Optional[CachedCalendar] = None
 
-    soup = BeautifulSoup(r.content, "html.parser")
-    table = soup.find("table")
-    rows = table.find_all("tr")
+
+class Subscription(NamedTuple):
+    channel_id: str
+    importance: int
+    countries: Optional[FrozenSet[str]]
+
+
+def load_subscriptions() -> List[Subscription]:
+    if not SUBSCRIPTIONS:
+        return [Subscription(os.environ["CHANNEL_ID"], IMPORTANCE_LEVEL, None)]
+
+    subscriptions = []
+    for item in json.loads(SUBSCRIPTIONS):
+        countries = item.get("countries")
+        subscriptions.append(
+            Subscription(
+                str(item["channel_id"]),
+                int(item.get("importance", IMPORTANCE_LEVEL)),
+                frozenset(countries) if countries else None,
+            )
+        )
+    return subscriptions
+
+
+@lru_cache(maxsize=None)
+def get_headers() -> dict:
+    # SSM はインポート時ではなく最初に投稿するときに読む
+    ssm_client = boto3.client("ssm")
+    ssm_response = ssm_client.get_parameters(
+        Names=["/sekimiya-ai/discord-token"],
+        WithDecryption=True,
+    )
+    discord_token = ssm_response["Parameters"][0]["Value"]
+
+    return {
+        "Authorization": f"Bot {discord_token}",
+        "Content-Type": "application/json",
+    }
+
+
+def get_indicators() -> list:
+    # 前回のカレンダーがあれば条件付き GET で確かめ、変わっていなければパースし直さない
+    global cached_calendar
+    headers = {}
+    if cached_calendar is not None:
+        if cached_calendar.etag:
+            headers["If-None-Match"] = cached_calendar.etag
+        if cached_calendar.last_modified:
+            headers["If-Modified-Since"] = cached_calendar.last_modified
+
+    r = session.get(CALENDAR_URL, headers=headers, timeout=REQUEST_TIMEOUT)
+    if r.status_code == 304 and cached_calendar is not None:
+        return cached_calendar.indicators
+    r.raise_for_status()
+
+    # ETag などを返さないこともあるので、中身のハッシュでも比べる
+    digest = hashlib.sha256(r.content).hexdigest()
+    if cached_calendar is not None and cached_calendar.digest == digest:
+        indicators = cached_calendar.indicators
+    else:
+        indicators = parse_indicators(r.content)
+
+    cached_calendar = CachedCalendar(
+        r.headers.get("ETag"), r.headers.get("Last-Modified"), digest, indicators
+    )
+    return indicators
+
+
+def parse_indicators(content: bytes) -> list:
+    # BeautifulSoup を挟まずに lxml の木をそのまま読む
+    # lxml は meta の charset が無いと UTF-8 と判断しないので、読めるなら先に decode する
+    try:
+        html = content.decode("utf-8")
+    except UnicodeDecodeError:
+        html = content
+    table = lxml.html.fromstring(html).find(".//table")
+    rows = table.iter("tr")
 
     indicators = []
     day = None
 
     for row in rows:
-        data = row.find_all("td")
+        data = row.xpath(".//td")
 
         if len(data) > 0:
-            if "/" in data[0].get_text():
-                day = data[0].get_text()
-                time_ = data[1].get_text()
-                country = data[2].get_text()
-                indicator = data[3].get_text()
-                importance = data[4].get_text()
+            if "/" in data[0].text_content():
+                day = data[0].text_content()
+                time_ = data[1].text_content()
+                country = data[2].text_content()
+                indicator = data[3].text_content()
+                importance = data[4].text_content()
 
             else:
-                time_ = data[0].get_text()
-                country = data[1].get_text()
-                indicator = data[2].get_text()
-                importance = data[3].get_text()
-
-            if "" not in time_ or importance.count("★") < IMPORTANCE_LEVEL:
-                continue
+                time_ = data[0].text_content()
+                country = data[1].text_content()
+                indicator = data[2].text_content()
+                importance = data[3].text_content()
 
+            # 重要度と国は配信先ごとに絞るので、ここでは全部残す
             indicators.append(
                 {
                     "day": day,
@@ -70,11 +157,21 @@ def get_indicators():
     return indicators
 
 
-def generate_message(indicators: list):
+@lru_cache(maxsize=None)
+def parse_day(year: int, day: str) -> datetime:
+    # "10/17(金)" のような日付。同じ日は何行も続くので一度だけ変換する
+    dt = datetime.strptime(f"{year}/{day.split('(')[0]}", "%Y/%m/%d")
+    return JST.localize(dt)
+
+
+def generate_message(
+    indicators: list,
+    importance: int = IMPORTANCE_LEVEL,
+    countries: Optional[FrozenSet[str]] = None,
+) -> Optional[str]:
     lines = ["今日と明日の経済指標カレンダーをお知らせします！", "```"]
 
-    jst = pytz.timezone("Asia/Tokyo")
-    now = datetime.now(jst)
+    now = datetime.now(JST)
     today = now.replace(hour=0, minute=0, second=0, microsecond=0)
     tomorrow = today + timedelta(days=1)
     day_after_tomorrow = tomorrow + timedelta(days=1)
@@ -83,11 +180,14 @@ def generate_message(indicators: list):
     # インジケータを整形
     formatted_indicators = {}
     for indicator in indicators:
+        if len(indicator["importance"]) < importance:
+            continue
+        if countries is not None and indicator["country"] not in countries:
+            continue
+
         day = indicator["day"]
         time = indicator["time"]
-        day_str = f"{current_year}/{day.split('(')[0]}"
-        dt = datetime.strptime(day_str, "%Y/%m/%d")
-        dt_jst = jst.localize(dt)
+        dt_jst = parse_day(current_year, day)
 
         if today <= dt_jst < day_after_tomorrow:
             if day not in formatted_indicators:
@@ -97,6 +197,10 @@ def generate_message(indicators: list):
                 f"{time} {indicator['country']} {indicator['indicator']} {indicator['importance']}"
             )
 
+    # 該当する指標が無ければ送らない
+    if not formatted_indicators:
+        return None
+
     for day, events in formatted_indicators.items():
         lines.append(f"■ {day}")
         for event in events:
@@ -108,16 +212,153 @@ def generate_message(indicators: list):
     return "\n".join(lines)
 
 
-def send_message(text):
-    payload = {
-        "content": text,
+class RateLimiter:
+    # Discord のレートリミットは「バケット + チャンネルなどの主要パラメータ」ごとに数えられる
+    # X-RateLimit-* を覚えておき、使い切ったバケットにはリセットまで投げない
+    def __init__(self):
+        self.buckets: Dict[str, str] = {}
+        self.reset_at: Dict[str, float] = {}
+        self.global_reset_at = 0.0
+
+    def key(self, route: str, major: str) -> str:
+        # バケットが分かるまではルートごとに数える
+        return f"{self.buckets.get(route, route)}:{major}"
+
+    async def wait(self, route: str, major: str):
+        loop = asyncio.get_running_loop()
+        while True:
+            reset_at = max(
+                self.reset_at.get(self.key(route, major), 0.0), self.global_reset_at
+            )
+            if reset_at <= loop.time():
+                return
+            await asyncio.sleep(reset_at - loop.time())
+
+    def update(self, route: str, major: str, headers):
+        if "X-RateLimit-Bucket" in headers:
+            self.buckets[route] = headers["X-RateLimit-Bucket"]
+        if (
+            headers.get("X-RateLimit-Remaining") == "0"
+            and "X-RateLimit-Reset-After" in headers
+        ):
+            self.limit(route, major, float(headers["X-RateLimit-Reset-After"]))
+
+    def limit(self, route: str, major: str, retry_after: float, is_global=False):
+        reset_at = asyncio.get_running_loop().time() + retry_after
+        if is_global:
+            self.global_reset_at = max(self.global_reset_at, reset_at)
+        else:
+            self.reset_at[self.key(route, major)] = reset_at
+
+
+def parse_rate_limit(body: str, headers) -> Tuple[float, bool]:
+    # 429 の本文は JSON とは限らない (プロキシの HTML など) ので、読めなければヘッダーを見る
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        data = {}
+    try:
+        retry_after = float(data.get("retry_after", headers.get("Retry-After", 1)))
+    except (TypeError, ValueError):
+        retry_after = 1.0
+    return retry_after, bool(data.get("global", False))
+
+
+async def post_message(
+    http: aiohttp.ClientSession, limiter: RateLimiter, channel_id: str, text: str
+) -> dict:
+    route = "POST /channels/{channel_id}/messages"
+    url = f"{DISCORD_API_BASE}/channels/{channel_id}/messages"
+    start = time.perf_counter()
+    status = None
+    error = None
+
+    for attempt in range(1, POST_MAX_RETRY + 1):
+        await limiter.wait(route, channel_id)
+        try:
+            async with http.post(url, json={"content": text}) as r:
+                limiter.update(route, channel_id, r.headers)
+                status = r.status
+                if r.status == 429:
+                    retry_after, is_global = parse_rate_limit(await r.text(), r.headers)
+                    limiter.limit(route, channel_id, retry_after, is_global)
+                    error = f"rate limited for {retry_after}s"
+                    if retry_after > MAX_RETRY_AFTER:
+                        break
+                    # 待つのは次の limiter.wait に任せる
+                    continue
+                if r.status < 500:
+                    # 400 系は送り直しても同じなのでそのまま諦める
+                    error = None if r.status < 400 else (await r.text())[:200]
+                    break
+                error = f"HTTP {r.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status = None
+            error = repr(e)
+
+        if attempt < POST_MAX_RETRY:
+            await asyncio.sleep(RETRY_BASE_DELAY * 2 ** (attempt - 1))
+
+    result = {
+        "channel_id": channel_id,
+        "status": status,
+        "attempts": attempt,
+        "latency_ms": round((time.perf_counter() - start) * 1000),
     }
-    requests.post(API_ENDPOINT, json=payload, headers=headers)
+    if error is not None:
+        result["error"] = error
+    return result
+
+
+async def post_messages(messages: List[Tuple[str, str]]) -> List[dict]:
+    # 1 回の実行の間は接続を使い回して、全チャンネルに並行して送る
+    limiter = RateLimiter()
+    async with aiohttp.ClientSession(
+        headers=get_headers(),
+        connector=aiohttp.TCPConnector(limit=MAX_CONCURRENT_POSTS),
+        timeout=aiohttp.ClientTimeout(total=POST_TIMEOUT),
+    ) as http:
+        results = await asyncio.gather(
+            *(
+                post_message(http, limiter, channel_id, text)
+                for channel_id, text in messages
+            ),
+            return_exceptions=True,
+        )
+
+    # 想定外の例外も、ほかのチャンネルの結果を巻き込まずにそのチャンネルの失敗として残す
+    return [
+        {"channel_id": channel_id, "status": None, "error": repr(result)}
+        if isinstance(result, BaseException)
+        else result
+        for (channel_id, _), result in zip(messages, results)
+    ]
 
 
 def handler(event, context):
-    text = generate_message(get_indicators())
-    send_message(text)
+    # カレンダーの取得とパースは 1 回だけにして、同じ条件の配信先とは本文も使い回す
+    indicators = get_indicators()
+    texts: Dict[Tuple[int, Optional[FrozenSet[str]]], Optional[str]] = {}
+    messages = []
+    deliveries = []
+    for subscription in load_subscriptions():
+        key = (subscription.importance, subscription.countries)
+        if key not in texts:
+            texts[key] = generate_message(indicators, *key)
+        if texts[key] is None:
+            deliveries.append({"channel_id": subscription.channel_id, "skipped": True})
+        else:
+            messages.append((subscription.channel_id, texts[key]))
+
+    if messages:
+        deliveries += asyncio.run(post_messages(messages))
+
+    # 失敗しても例外にはしない。再実行されると届いたチャンネルにも二重に送ってしまう
+    report = {"deliveries": deliveries}
+    print(json.dumps(report, ensure_ascii=False))
+    return report
 
 
 if __name__ == "__main__":